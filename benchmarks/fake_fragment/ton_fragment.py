@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Локальная замена модуля ton_fragment для нагрузочного тестирования
+Те же функции, что использует бэкенд, но каталог генерируется в памяти,
+а задержка и доля ошибок задаются переменными окружения:
+
+    FAKE_FRAGMENT_SIZE         количество подарков (10000)
+    FAKE_FRAGMENT_COLLECTIONS  количество коллекций (50)
+    FAKE_FRAGMENT_LATENCY_MS   средняя задержка вызова в мс (50)
+    FAKE_FRAGMENT_JITTER_MS    разброс задержки в мс (20)
+    FAKE_FRAGMENT_ERROR_RATE   доля вызовов, завершающихся ошибкой (0)
+    FAKE_FRAGMENT_CHURN        доля подарков, меняющих цену между вызовами get_all_gifts (0.01)
+    FAKE_FRAGMENT_SEED         начальное значение генератора (42)
+
+Подключение: добавить каталог benchmarks/fake_fragment в начало PYTHONPATH.
+"""
+
+import os
+import time
+import random
+import threading
+
+__version__ = "0.0-fake"
+
+
+class FragmentAPIError(Exception):
+    """Имитация ошибки Fragment API."""
+
+
+# Текущие настройки (можно изменить через configure)
+settings = {
+    "size": int(os.getenv("FAKE_FRAGMENT_SIZE", "10000")),
+    "collections": int(os.getenv("FAKE_FRAGMENT_COLLECTIONS", "50")),
+    "latency_ms": float(os.getenv("FAKE_FRAGMENT_LATENCY_MS", "50")),
+    "jitter_ms": float(os.getenv("FAKE_FRAGMENT_JITTER_MS", "20")),
+    "error_rate": float(os.getenv("FAKE_FRAGMENT_ERROR_RATE", "0")),
+    "churn": float(os.getenv("FAKE_FRAGMENT_CHURN", "0.01")),
+    "seed": int(os.getenv("FAKE_FRAGMENT_SEED", "42")),
+}
+
+_lock = threading.Lock()
+_random = random.Random(settings["seed"])
+_gifts = []
+_by_id = {}
+
+
+# Генерация каталога в формате ответа ton_fragment
+def _generate():
+    global _gifts, _by_id
+    rnd = random.Random(settings["seed"])
+    collections = [f"Collection{i}" for i in range(settings["collections"])]
+    statuses = ['for_sale', 'on_auction', 'not_for_sale']
+
+    _gifts = [
+        {
+            "id": i,
+            "name": f"Gift #{i}",
+            "owner": f"owner{rnd.randint(1, 5000)}",
+            "collection": rnd.choice(collections),
+            "status": rnd.choice(statuses),
+            "price": rnd.randint(10, 100000),
+            "model": {"name": f"Model{rnd.randint(0, 199)}", "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "background": {"name": f"Background{rnd.randint(0, 79)}", "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "symbol": {"name": f"Symbol{rnd.randint(0, 119)}", "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "supply": f"{rnd.randint(1, 5000)}/10000",
+            "image": f"https://fragment.com/gift/{i}.webp",
+            "animated_image": f"https://fragment.com/gift/{i}.tgs",
+            "url": f"https://fragment.com/gift/{i}"
+        }
+        for i in range(settings["size"])
+    ]
+    _by_id = {str(gift["id"]): gift for gift in _gifts}
+
+
+# Изменение настроек и пересоздание каталога (для запуска в одном процессе)
+def configure(**kwargs):
+    with _lock:
+        settings.update(kwargs)
+        _random.seed(settings["seed"])
+        _generate()
+
+
+# Задержка и случайная ошибка вызова
+def _simulate_call(name):
+    latency = settings["latency_ms"] + _random.uniform(-1, 1) * settings["jitter_ms"]
+    if latency > 0:
+        time.sleep(latency / 1000)
+    if settings["error_rate"] and _random.random() < settings["error_rate"]:
+        raise FragmentAPIError(f"Simulated {name} failure")
+
+
+class Client:
+    def __init__(self, api_key=None, api_secret=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.session = None
+
+
+def get_all_gifts(client):
+    _simulate_call('get_all_gifts')
+    with _lock:
+        # Часть цен меняется между вызовами, чтобы обновления каталога не были пустыми
+        for _ in range(int(len(_gifts) * settings["churn"])):
+            gift = _gifts[_random.randrange(len(_gifts))]
+            gift["price"] = _random.randint(10, 100000)
+        return [dict(gift) for gift in _gifts]
+
+
+def get_gifts_by_collection(client, collection):
+    _simulate_call('get_gifts_by_collection')
+    with _lock:
+        return [dict(gift) for gift in _gifts if gift["collection"] == collection]
+
+
+def get_all_collections(client):
+    _simulate_call('get_all_collections')
+    return [{"id": i, "name": f"Collection{i}"} for i in range(settings["collections"])]
+
+
+def get_gift_by_id(client, gift_id):
+    _simulate_call('get_gift_by_id')
+    with _lock:
+        gift = _by_id.get(str(gift_id))
+        return dict(gift) if gift else None
+
+
+def buy_gift(client, gift_id, recipient):
+    _simulate_call('buy_gift')
+    if str(gift_id) not in _by_id:
+        return {"success": False, "error": "Gift not found"}
+    return {"success": True, "transaction_id": f"fake-{gift_id}-{_random.randrange(1 << 32):08x}"}
+
+
+_generate()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Нагрузочный бенчмарк бэкенда Fragment
+Запускает fragment_asgi.py с локальной заменой ton_fragment (benchmarks/fake_fragment),
+нагружает маршруты API на заданных уровнях параллельности и сохраняет
+пропускную способность и задержки p50/p95/p99 в JSON для сравнения между версиями
+
+Запуск: python benchmarks/load_bench.py --concurrency 1,8,32 --requests 500
+        python benchmarks/load_bench.py --compare benchmarks/results/baseline.json
+        python benchmarks/load_bench.py --url http://localhost:5000   (уже запущенный сервер)
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_FRAGMENT_PATH = os.path.join(ROOT, 'benchmarks', 'fake_fragment')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+# Сценарии нагрузки: функция (генератор случайных чисел, размер каталога) -> (метод, путь, JSON тело)
+SCENARIOS = {
+    "gifts": lambda rnd, size: (
+        'GET', f"/api/fragment/gifts?status=available&limit=50&offset={rnd.randrange(0, max(size, 1), 50)}", None
+    ),
+    "gifts_full": lambda rnd, size: ('GET', "/api/fragment/gifts", None),
+    "gift_by_id": lambda rnd, size: ('GET', f"/api/fragment/gifts/{rnd.randrange(size)}", None),
+    "collections": lambda rnd, size: ('GET', "/api/fragment/collections", None),
+    "update": lambda rnd, size: ('POST', "/api/fragment/update", None),
+    "buy": lambda rnd, size: (
+        'POST', "/api/fragment/buy", {"giftId": str(rnd.randrange(size)), "recipient": f"bench{rnd.randrange(1000)}"}
+    ),
+}
+
+# Сценарии с тяжелыми запросами выполняются меньшее число раз
+HEAVY_SCENARIOS = {"update", "gifts_full"}
+
+
+# Процентиль по отсортированному списку (nearest-rank)
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Запуск сервера с поддельным ton_fragment во временном каталоге данных
+def start_server(args, workdir):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [FAKE_FRAGMENT_PATH, ROOT, env.get("PYTHONPATH")])),
+        "FRAGMENT_PORT": str(port),
+        "FRAGMENT_HOST": "127.0.0.1",
+        "FRAGMENT_WORKERS": str(args.workers),
+        "FRAGMENT_CATALOG_DB": os.path.join(workdir, 'catalog.db'),
+        "FRAGMENT_PURCHASES_DB": os.path.join(workdir, 'purchases.db'),
+        "FRAGMENT_LOG_FILE": os.path.join(workdir, 'backend.log'),
+        "FRAGMENT_JSON_EXPORT": "0",
+        "FAKE_FRAGMENT_SIZE": str(args.size),
+        "FAKE_FRAGMENT_LATENCY_MS": str(args.latency_ms),
+        "FAKE_FRAGMENT_ERROR_RATE": str(args.error_rate),
+    })
+
+    output = open(os.path.join(workdir, 'server.out'), 'wb')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'fragment_asgi.py')],
+        cwd=ROOT, env=env, stdout=output, stderr=subprocess.STDOUT
+    )
+    return process, f"http://127.0.0.1:{port}"
+
+
+# Ожидание готовности сервера
+def wait_until_up(url, process=None, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/api/fragment/health", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start in {timeout} s")
+
+
+# Прогон одного сценария на заданном уровне параллельности
+def run_scenario(url, name, concurrency, total, size, seed):
+    build = SCENARIOS[name]
+    local = threading.local()
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    latencies = []
+    errors = []
+    results_lock = threading.Lock()
+
+    def worker(worker_id):
+        rnd = random.Random(seed * 1000 + worker_id)
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+
+        while True:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+
+            method, path, body = build(rnd, size)
+            headers = {"Idempotency-Key": uuid.uuid4().hex} if name == "buy" else {}
+            started = time.perf_counter()
+            try:
+                response = session.request(method, f"{url}{path}", json=body, headers=headers, timeout=60)
+                failed = response.status_code >= 400
+            except requests.RequestException as e:
+                failed = True
+                response = e
+            elapsed = time.perf_counter() - started
+
+            with results_lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors.append(getattr(response, 'status_code', type(response).__name__))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "errorCodes": sorted({str(code) for code in errors}),
+        "durationS": round(duration, 3),
+        "throughputRps": round(len(latencies) / duration, 2) if duration else None,
+        "meanMs": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50Ms": to_ms(percentile(latencies, 50)),
+        "p95Ms": to_ms(percentile(latencies, 95)),
+        "p99Ms": to_ms(percentile(latencies, 99)),
+        "maxMs": to_ms(latencies[-1] if latencies else None),
+    }
+
+
+# Сравнение с сохраненными результатами
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(item["scenario"], item["concurrency"]): item for item in json.load(f)["results"]}
+
+    def change(new, old):
+        if new is None or not old:
+            return "     n/a"
+        return f"{(new - old) / old * 100:+7.1f}%"
+
+    print(f"\nСравнение с {baseline_path}")
+    print(f"{'сценарий':<14}{'парал.':>7}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for item in results:
+        old = baseline.get((item["scenario"], item["concurrency"]))
+        if old is None:
+            continue
+        print(f"{item['scenario']:<14}{item['concurrency']:>7}"
+              f"{change(item['throughputRps'], old['throughputRps']):>10}"
+              f"{change(item['p50Ms'], old['p50Ms']):>10}"
+              f"{change(item['p95Ms'], old['p95Ms']):>10}"
+              f"{change(item['p99Ms'], old['p99Ms']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк бэкенда Fragment")
+    parser.add_argument('--url', help="адрес уже запущенного сервера (без запуска своего)")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS), help="сценарии через запятую")
+    parser.add_argument('--concurrency', default="1,8,32", help="уровни параллельности через запятую")
+    parser.add_argument('--requests', type=int, default=500, help="запросов на сценарий и уровень")
+    parser.add_argument('--heavy-requests', type=int, default=20, help="запросов для update и gifts_full")
+    parser.add_argument('--size', type=int, default=10000, help="размер поддельного каталога")
+    parser.add_argument('--latency-ms', type=float, default=50, help="задержка поддельного API в мс")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ошибок поддельного API")
+    parser.add_argument('--workers', type=int, default=1, help="количество процессов uvicorn")
+    parser.add_argument('--seed', type=int, default=42, help="начальное значение генератора запросов")
+    parser.add_argument('--cold', action='store_true', help="не загружать каталог перед измерениями")
+    parser.add_argument('--output', help="файл результатов (по умолчанию benchmarks/results/load-<время>.json)")
+    parser.add_argument('--compare', help="файл результатов предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    process = None
+    workdir = tempfile.mkdtemp(prefix='fragment-bench-')
+    url = args.url
+    try:
+        if url is None:
+            process, url = start_server(args, workdir)
+        wait_until_up(url, process)
+
+        if not args.cold:
+            requests.post(f"{url}/api/fragment/update", timeout=120)
+
+        results = []
+        for name in scenarios:
+            total = args.heavy_requests if name in HEAVY_SCENARIOS else args.requests
+            for level in levels:
+                result = run_scenario(url, name, level, total, args.size, args.seed)
+                results.append(result)
+                print(f"{name:<14} c={level:<4} {result['throughputRps']:>9.1f} rps  "
+                      f"p50 {result['p50Ms']:>8.1f} мс  p95 {result['p95Ms']:>8.1f} мс  "
+                      f"p99 {result['p99Ms']:>8.1f} мс  ошибок {result['errors']}")
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        },
+        "results": results,
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
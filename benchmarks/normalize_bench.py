@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк нормализации подарков
+Сравнивает gift_to_dict (по одному словарю) с колоночной нормализацией GiftColumns:
+отдельно словари, словари вместе с JSON строками подарков для хранилища
+(путь фонового обновления) и JSON экспорт каталога
+
+Запуск: python benchmarks/normalize_bench.py --size 50000 --repeat 5
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fragment_normalize import GiftColumns, gift_to_dict, json_rows, normalize_gifts, normalize_catalog
+
+
+# Генерация подарков в формате ответа ton_fragment
+def make_upstream_gifts(size, seed=42):
+    rnd = random.Random(seed)
+    collections = [f"Collection{i}" for i in range(50)]
+    models = [f"Model{i}" for i in range(200)]
+    backgrounds = [f"Background{i}" for i in range(80)]
+    symbols = [f"Symbol{i}" for i in range(120)]
+    statuses = ['for_sale', 'on_auction', 'not_for_sale']
+
+    return [
+        {
+            "id": i,
+            "name": f"Gift #{i}",
+            "owner": f"owner{rnd.randint(1, 5000)}",
+            "collection": rnd.choice(collections),
+            "status": rnd.choice(statuses),
+            "price": rnd.randint(10, 100000),
+            "model": {"name": rnd.choice(models), "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "background": {"name": rnd.choice(backgrounds), "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "symbol": {"name": rnd.choice(symbols), "rarity": round(rnd.uniform(0.1, 5.0), 1)},
+            "supply": f"{rnd.randint(1, 5000)}/10000",
+            "image": f"https://fragment.com/gift/{i}.webp",
+            "animated_image": f"https://fragment.com/gift/{i}.tgs",
+            "url": f"https://fragment.com/gift/{i}"
+        }
+        for i in range(size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк нормализации подарков")
+    parser.add_argument('--size', type=int, default=20000, help="количество подарков")
+    parser.add_argument('--repeat', type=int, default=5, help="количество повторов")
+    args = parser.parse_args()
+
+    gifts = make_upstream_gifts(args.size)
+
+    # Проверяем, что оба способа дают одинаковый результат (JSON строки совпадают побайтно,
+    # иначе хэши подарков в хранилище менялись бы при смене способа нормализации)
+    reference = [gift_to_dict(gift) for gift in gifts]
+    reference_rows = json_rows(reference)
+    catalog = normalize_catalog(gifts)
+    assert catalog == reference
+    assert catalog.json_rows == reference_rows
+    assert GiftColumns.from_upstream(gifts).to_json() == json.dumps(reference, ensure_ascii=False,
+                                                                    separators=(',', ':'))
+
+    cases = {
+        # Только словари (холодный путь запроса к API)
+        "gift_to_dict": lambda: [gift_to_dict(gift) for gift in gifts],
+        "normalize_gifts": lambda: normalize_gifts(gifts),
+        # Словари и JSON строки подарков для хранилища (фоновое обновление)
+        "gift_to_dict + json_rows": lambda: json_rows([gift_to_dict(gift) for gift in gifts]),
+        "normalize_catalog": lambda: normalize_catalog(gifts),
+        # JSON экспорт каталога из готовых словарей или строк
+        "json.dumps каталога": lambda: json.dumps(reference, ensure_ascii=False, separators=(',', ':')),
+        "склейка json_rows": lambda: '[' + ','.join(catalog.json_rows) + ']',
+    }
+
+    print(f"Подарков: {args.size}, повторов: {args.repeat}")
+    for name, func in cases.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:<28} {best * 1000:9.1f} мс  ({args.size / best:,.0f} подарков/с)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fragment API Backend (ASGI)
+Асинхронный режим работы бэкенда для production-сервера (uvicorn)
+
+Все маршруты /api/fragment/* обрабатываются тем же Flask приложением, но
+в ограниченном пуле потоков и с таймаутом на запрос, поэтому медленные
+вызовы ton_fragment не блокируют цикл событий. Запрос подарков из нескольких
+коллекций (?collection=A&collection=B) выполняется параллельно, а поток
+изменений /api/fragment/gifts/stream (Server-Sent Events) обслуживается
+прямо в цикле событий.
+
+Запуск: python fragment_asgi.py
+"""
+
+import os
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import functools
+import contextvars
+from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import fragment_backend as backend
+from fragment_catalog import sort_key
+from fragment_events import ChangeBroadcaster, format_event
+from fragment_logging import bind_request, unbind_request, new_request_id
+
+logger = logging.getLogger(__name__)
+
+# Размер пула потоков для блокирующих вызовов
+EXECUTOR_THREADS = int(os.getenv("FRAGMENT_ASGI_THREADS", "16"))
+
+# Таймаут обработки одного запроса в секундах
+REQUEST_TIMEOUT = float(os.getenv("FRAGMENT_ASGI_TIMEOUT", "30"))
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS, thread_name_prefix="fragment-asgi")
+
+
+# Выполнение блокирующей функции в пуле потоков с таймаутом (контекст запроса переходит в поток).
+# По таймауту клиент получает ответ сразу, но поток пула остается занят, пока функция не завершится:
+# вызовы Fragment API в ней ограничены FRAGMENT_CALL_TIMEOUT на попытку (с повторами), поэтому
+# поток освобождается не позже чем через (FRAGMENT_RETRIES + 1) * FRAGMENT_CALL_TIMEOUT и задержки повторов
+async def run_blocking(func, *args, timeout=None):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args)
+    return await asyncio.wait_for(loop.run_in_executor(executor, call), timeout or REQUEST_TIMEOUT)
+
+
+# Интервал проверки изменений каталога для потока событий (в секундах)
+STREAM_POLL_INTERVAL = float(os.getenv("FRAGMENT_STREAM_POLL_INTERVAL", "1"))
+
+# Интервал комментариев keep-alive в простаивающем потоке
+STREAM_HEARTBEAT = float(os.getenv("FRAGMENT_STREAM_HEARTBEAT", "15"))
+
+# Минимальная пауза между событиями одному клиенту (изменения за паузу сливаются)
+STREAM_MIN_INTERVAL = float(os.getenv("FRAGMENT_STREAM_MIN_INTERVAL", "1"))
+
+broadcaster = ChangeBroadcaster(
+    backend.gift_catalog,
+    run_blocking,
+    poll_interval=STREAM_POLL_INTERVAL,
+    max_subscribers=int(os.getenv("FRAGMENT_STREAM_MAX_CLIENTS", "5000")),
+    max_pending=int(os.getenv("FRAGMENT_STREAM_MAX_PENDING", "1000"))
+)
+
+backend.metrics.gauge(
+    'fragment_stream_subscribers', 'Open change stream connections', lambda: broadcaster.subscribers
+)
+
+
+# Сериализация JSON ответа в том же формате, что и jsonify
+def json_body(payload):
+    return backend.app.json.dumps(payload).encode('utf-8') + b'\n'
+
+
+# Отправка JSON ответа
+async def send_json(send, payload, status=200):
+    await send_body(send, json_body(payload), status)
+
+
+# Отправка готового тела JSON ответа
+async def send_body(send, body, status=200):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# Чтение тела запроса
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+# Формирование WSGI окружения из ASGI scope
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+# Синхронный вызов Flask приложения (выполняется в пуле потоков)
+def call_wsgi(environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    result = backend.app.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return response['status'], response['headers'], body
+
+
+# Загрузка подарков из одной коллекции через API
+def fetch_collection(collection):
+    return backend.fetch_gifts(collection)
+
+
+# Тело ответа с подарками нескольких коллекций из снимка каталога; None, если снимок еще не готов
+def snapshot_gifts_for_collections(collections, status, params):
+    if not backend.snapshot_ready():
+        return None
+
+    if params["sort"]:
+        # Слияние заранее отсортированных индексов коллекций
+        gifts = list(heapq.merge(
+            *(backend.gift_catalog.query(collection, status, params["sort"])
+              for collection in collections),
+            key=sort_key(params["sort"])
+        ))
+    else:
+        gifts = [gift for collection in collections
+                 for gift in backend.gift_catalog.filter(collection, status)]
+
+    return json_body(backend.gifts_payload(gifts, params, backend.gift_catalog.snapshot()["lastUpdated"]))
+
+
+# Тело ответа из результатов API; коллекции, которые не удалось получить, берутся из снимка каталога
+def merge_collection_results(collections, results, status, params):
+    gifts = []
+    from_cache = False
+    for collection, result in zip(collections, results):
+        if isinstance(result, BaseException):
+            logger.error("Ошибка при получении подарков коллекции %s через API: %r", collection, result)
+            gifts.extend(backend.gift_catalog.filter(collection, status))
+            from_cache = True
+        else:
+            gifts.extend(backend.filter_by_status(result, status))
+
+    if params["sort"]:
+        gifts = backend.sort_gifts(gifts, params["sort"])
+
+    last_updated = backend.gift_catalog.snapshot()["lastUpdated"] if from_cache else datetime.now().isoformat()
+    payload = backend.gifts_payload(gifts, params, last_updated)
+    if from_cache:
+        payload["fromCache"] = True
+        backend.count_fallback('fromCache', route='get_gifts')
+
+    return json_body(payload)
+
+
+# Параллельное получение подарков из нескольких коллекций
+async def get_gifts_for_collections(send, collections, status, params):
+    logger.info("Запрос на получение подарков (коллекции: %s, статус: %s)", ', '.join(collections), status)
+
+    # Обращения к каталогу могут читать SQLite и перезагружать снимок, поэтому
+    # выполняются в пуле потоков, а не в цикле событий
+    body = await run_blocking(snapshot_gifts_for_collections, collections, status, params)
+
+    # Если каталог еще не загружен, запрашиваем коллекции через API параллельно
+    if body is None:
+        results = await asyncio.gather(
+            *(run_blocking(fetch_collection, collection) for collection in collections),
+            return_exceptions=True
+        )
+        body = await run_blocking(merge_collection_results, collections, results, status, params)
+
+    await send_body(send, body)
+
+
+# Поток изменений каталога (Server-Sent Events)
+async def stream_changes(scope, receive, send, params):
+    try:
+        await asyncio.wait_for(broadcaster.wait_ready(), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        await send_json(send, {"success": False, "error": "Catalog is not loaded yet"}, 503)
+        return
+
+    subscription = broadcaster.subscribe(params.get('collection'))
+    if subscription is None:
+        await send_json(send, {"success": False, "error": "Too many subscribers"}, 503)
+        return
+
+    # Отслеживаем отключение клиента, чтобы сразу освободить подписку
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                subscription.close()
+                return
+
+    watcher = asyncio.get_running_loop().create_task(watch_disconnect())
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*'),
+            ],
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': b'retry: 5000\n\n' + format_event('ready', {"version": subscription.version}, subscription.version),
+            'more_body': True,
+        })
+
+        # При переподключении досылаем изменения после последнего полученного события
+        headers = dict(scope.get('headers', []))
+        since = headers.get(b'last-event-id', b'').decode('latin-1') or params.get('since', [None])[0]
+        if since and since != subscription.version:
+            await broadcaster.replay(subscription, since)
+
+        while not subscription.closed:
+            if not await subscription.wait(STREAM_HEARTBEAT):
+                await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                continue
+            if subscription.closed:
+                break
+
+            event = subscription.drain()
+            if event is not None:
+                name, data = event
+                await send({'type': 'http.response.body', 'body': format_event(name, data, data["version"]),
+                            'more_body': True})
+                await asyncio.sleep(STREAM_MIN_INTERVAL)
+
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        broadcaster.unsubscribe(subscription)
+
+
+# Обработка событий жизненного цикла сервера
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Прогрев каталога и фоновое обновление идут в фоне, сервер принимает запросы сразу
+            backend.start_warm_up()
+            broadcaster.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await broadcaster.stop()
+            backend.catalog_refresher.stop()
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# ASGI приложение
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    # ID запроса передается во Flask через заголовок, чтобы записи лога обоих уровней совпадали
+    request_id = dict(scope.get('headers', [])).get(b'x-request-id', b'').decode('latin-1')
+    if not request_id:
+        request_id = new_request_id()
+        scope = dict(scope, headers=list(scope.get('headers', [])) + [(b'x-request-id', request_id.encode('latin-1'))])
+
+    sampled = scope['path'] != '/api/fragment/gifts' or backend.log_sampler.sampled('get_gifts')
+    tokens = bind_request(request_id, sampled)
+    try:
+        await handle_http(scope, receive, send)
+    finally:
+        unbind_request(tokens)
+
+
+# Обработка HTTP запроса
+async def handle_http(scope, receive, send):
+    body = await read_body(receive)
+
+    if scope['method'] == 'GET' and scope['path'] == '/api/fragment/gifts/stream':
+        await stream_changes(scope, receive, send, parse_qs(scope.get('query_string', b'').decode('utf-8', 'replace')))
+        return
+
+    if scope['method'] == 'GET' and scope['path'] == '/api/fragment/gifts':
+        params = parse_qs(scope.get('query_string', b'').decode('utf-8', 'replace'))
+        # Повторяющиеся коллекции запрашиваются один раз
+        collections = list(dict.fromkeys(params.get('collection', [])))
+        if len(collections) > 1:
+            status = params.get('status', ['all'])[0]
+            try:
+                list_params = backend.parse_list_params({key: values[0] for key, values in params.items()})
+            except ValueError as e:
+                await send_json(send, {"success": False, "error": str(e)}, 400)
+                return
+            started = time.perf_counter()
+            response_status = 200
+            try:
+                await get_gifts_for_collections(send, collections, status, list_params)
+            except Exception as e:
+                logger.error("Ошибка при обработке запроса: %s", e)
+                response_status = 500
+                await send_json(send, {"success": False, "error": str(e)}, 500)
+            backend.request_latency.observe(
+                time.perf_counter() - started, route='get_gifts', method='GET', status=response_status
+            )
+            return
+
+    try:
+        status, headers, response_body = await run_blocking(call_wsgi, build_environ(scope, body))
+    except asyncio.TimeoutError:
+        logger.error("Превышено время обработки запроса %s %s", scope['method'], scope['path'])
+        await send_json(send, {"success": False, "error": "Request timed out"}, 504)
+        return
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response_body})
+
+
+# Запуск production-сервера
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        logger.error("Для запуска ASGI сервера установите uvicorn: pip install uvicorn")
+        sys.exit(1)
+
+    # Каждый процесс запускает свое фоновое обновление каталога, кэш Fragment API и
+    # очередь покупок, поэтому по умолчанию сервер работает в одном процессе
+    uvicorn.run(
+        "fragment_asgi:app",
+        host=os.getenv("FRAGMENT_HOST", "0.0.0.0"),
+        port=int(os.getenv("FRAGMENT_PORT", "5000")),
+        workers=int(os.getenv("FRAGMENT_WORKERS", "1")),
+        log_level="info"
+    )
@@ -7,62 +7,165 @@ Fragment API Backend
 """
 
 import os
-import json
+import time
 import logging
-from datetime import datetime
-from flask import Flask, jsonify, request
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 from dotenv import load_dotenv
-import ton_fragment as fragment
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("fragment_backend.log"),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from fragment_catalog import (GiftCatalog, JsonFileSource, SnapshotWriter, STATUS_GROUPS, SORT_KEYS, sort_gifts,
+                              project_gifts, empty_collection_stats)
+from fragment_store import CatalogStore
+from fragment_cache import UpstreamCache, ResponseCache, CachedResponse
+from fragment_refresher import CatalogRefresher
+from fragment_normalize import gift_to_dict, normalize_gifts, normalize_catalog
+from fragment_upstream import UpstreamClient, CircuitBreaker
+from fragment_purchases import PurchaseJournal, PurchaseQueue, IdempotencyConflictError, QueueFullError
+from fragment_metrics import MetricsRegistry
+from fragment_logging import configure_logging, LogSampler, bind_request, unbind_request, new_request_id
 
 # Загрузка переменных окружения
 load_dotenv()
 
+# Настройка логирования (запись в файл и вывод выполняются в отдельном потоке)
+log_listener = configure_logging(
+    os.getenv("FRAGMENT_LOG_FILE", "fragment_backend.log"),
+    max_bytes=int(os.getenv("FRAGMENT_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    backups=int(os.getenv("FRAGMENT_LOG_BACKUPS", "5")),
+    json_format=os.getenv("FRAGMENT_LOG_FORMAT", "json") == "json"
+)
+logger = logging.getLogger(__name__)
+
+# INFO записи частых маршрутов чтения пишутся только для доли запросов
+log_sampler = LogSampler(
+    rate=float(os.getenv("FRAGMENT_LOG_SAMPLE_RATE", "0.1")),
+    routes=('get_gifts', 'get_gift_by_id', 'get_gift_changes', 'get_collections', 'get_purchase', 'get_metrics',
+            'get_health')
+)
+
 # Инициализация Flask приложения
 app = Flask(__name__)
 CORS(app)  # Разрешаем CORS для всех маршрутов
 
-# Инициализация Fragment API
-fragment_client = fragment.Client(
-    api_key=os.getenv("FRAGMENT_API_KEY", ""),
-    api_secret=os.getenv("FRAGMENT_API_SECRET", "")
+# Метрики процесса (отдаются в формате Prometheus на /metrics)
+metrics = MetricsRegistry()
+request_latency = metrics.histogram(
+    'fragment_request_duration_seconds', 'Request latency by route'
+)
+upstream_latency = metrics.histogram(
+    'fragment_upstream_call_duration_seconds', 'Fragment API call latency by call and outcome'
+)
+fallbacks = metrics.counter(
+    'fragment_fallback_total', 'Responses served from a fallback path (fromCache, isTestData)'
+)
+
+# Учет ответа, отданного из резервного источника данных
+def count_fallback(kind, route=None):
+    fallbacks.inc(route=route or request.endpoint, kind=kind)
+
+# Импорт ton_fragment откладывается до первого вызова API, чтобы не замедлять запуск
+def load_fragment_module():
+    import ton_fragment
+    return ton_fragment
+
+# Инициализация Fragment API (пул клиентов с таймаутами, повторами и выключателем)
+fragment_client = UpstreamClient(
+    load_fragment_module,
+    lambda module: module.Client(
+        api_key=os.getenv("FRAGMENT_API_KEY", ""),
+        api_secret=os.getenv("FRAGMENT_API_SECRET", "")
+    ),
+    pool_size=int(os.getenv("FRAGMENT_POOL_SIZE", "8")),
+    connect_timeout=float(os.getenv("FRAGMENT_CONNECT_TIMEOUT", "5")),
+    read_timeout=float(os.getenv("FRAGMENT_READ_TIMEOUT", "15")),
+    call_timeout=float(os.getenv("FRAGMENT_CALL_TIMEOUT", "20")),
+    retries=int(os.getenv("FRAGMENT_RETRIES", "2")),
+    backoff_base=float(os.getenv("FRAGMENT_BACKOFF_BASE", "0.5")),
+    backoff_max=float(os.getenv("FRAGMENT_BACKOFF_MAX", "8")),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv("FRAGMENT_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("FRAGMENT_BREAKER_RESET", "30"))
+    ),
+    on_call=lambda name, duration, error: upstream_latency.observe(
+        duration, call=name, outcome='ok' if error is None else 'error'
+    )
+)
+
+# Кэш ответов Fragment API (ключ: endpoint, коллекция)
+upstream_cache = UpstreamCache(
+    ttl=float(os.getenv("FRAGMENT_CACHE_TTL", "60")),
+    stale_ttl=float(os.getenv("FRAGMENT_CACHE_STALE_TTL", "600")),
+    max_entries=int(os.getenv("FRAGMENT_CACHE_MAX_ENTRIES", "128"))
 )
 
-# Путь к файлу с данными подарков
+# Путь к файлу с данными подарков (экспорт каталога для Node-сервисов и Mini App)
 GIFTS_DATA_PATH = os.path.join(os.path.dirname(__file__), 'public', 'fragment_gifts.json')
 
-# Функция для сохранения данных подарков в JSON файл
+# Путь к хранилищу каталога в SQLite
+CATALOG_DB_PATH = os.getenv("FRAGMENT_CATALOG_DB", os.path.join(os.path.dirname(__file__), 'fragment_catalog.db'))
+
+# Экспорт каталога в JSON файл (можно отключить через FRAGMENT_JSON_EXPORT=0)
+JSON_EXPORT_ENABLED = os.getenv("FRAGMENT_JSON_EXPORT", "1") == "1"
+
+# Хранилище каталога и каталог подарков в памяти процесса
+# (записи других процессов проверяются не чаще раза в FRAGMENT_CATALOG_CHECK_INTERVAL секунд)
+catalog_store = CatalogStore(
+    CATALOG_DB_PATH,
+    history=int(os.getenv("FRAGMENT_CHANGES_HISTORY", "100"))
+)
+gift_catalog = GiftCatalog(
+    catalog_store,
+    check_interval=float(os.getenv("FRAGMENT_CATALOG_CHECK_INTERVAL", "1"))
+)
+
+# Запись JSON экспорта (сжатая копия .gz включается через FRAGMENT_SNAPSHOT_GZIP)
+snapshot_writer = SnapshotWriter(
+    GIFTS_DATA_PATH,
+    compress=os.getenv("FRAGMENT_SNAPSHOT_GZIP", "0") == "1"
+)
+
+# Функция для сохранения данных подарков (в хранилище записываются только изменения)
 def save_gifts_data(gifts_data):
     try:
-        with open(GIFTS_DATA_PATH, 'w', encoding='utf-8') as f:
-            json.dump(gifts_data, f, ensure_ascii=False, indent=2)
-        logger.info(f"Данные подарков сохранены в {GIFTS_DATA_PATH}")
+        diff = catalog_store.upsert(gifts_data["gifts"], gifts_data["lastUpdated"], gifts_data.get("isTestData", False))
+        
+        if diff["unchanged"]:
+            # Снимок не изменился: оставляем текущую версию, чтобы ETag клиентов оставались валидными
+            logger.info("Данные подарков не изменились, запись пропущена")
+        else:
+            # JSON строки нормализации нужны только для записи, в памяти каталога их не держим
+            gift_catalog.replace(dict(gifts_data, gifts=list(gifts_data["gifts"])), version=diff["version"])
+            logger.info("Данные подарков сохранены в %s", CATALOG_DB_PATH)
+        
+        if JSON_EXPORT_ENABLED:
+            snapshot_writer.write(gifts_data)
         return True
     except Exception as e:
-        logger.error(f"Ошибка при сохранении данных подарков: {e}")
+        logger.error("Ошибка при сохранении данных подарков: %s", e)
         return False
 
-# Функция для загрузки данных подарков из JSON файла
+# Функция для загрузки данных подарков
+# (каталог перечитывается из хранилища только при изменении)
 def load_gifts_data():
-    try:
-        if os.path.exists(GIFTS_DATA_PATH):
-            with open(GIFTS_DATA_PATH, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {"gifts": [], "lastUpdated": None}
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке данных подарков: {e}")
-        return {"gifts": [], "lastUpdated": None}
+    return gift_catalog.snapshot()
+
+# Можно ли отвечать из снимка каталога: в нем есть подарки, и это не тестовые данные
+# (снимок, прогретый из хранилища, используется и до первого обновления из API)
+def snapshot_ready():
+    snapshot = gift_catalog.snapshot()
+    return bool(snapshot["gifts"]) and not snapshot.get("isTestData")
+
+# Перенос каталога из JSON файла при первом запуске с хранилищем SQLite
+def import_json_snapshot():
+    if len(catalog_store) or not os.path.exists(GIFTS_DATA_PATH):
+        return
+    
+    loaded = JsonFileSource(GIFTS_DATA_PATH).load()
+    if loaded and loaded[0]["gifts"]:
+        catalog_store.upsert(loaded[0]["gifts"], loaded[0]["lastUpdated"])
+        logger.info("Каталог перенесен из %s: %s подарков", GIFTS_DATA_PATH, len(loaded[0]['gifts']))
 
 # Функция для создания тестовых данных
 def create_test_data():
@@ -122,43 +225,373 @@ def create_test_data():
     
     gifts_data = {
         "gifts": test_gifts,
-        "lastUpdated": datetime.now().isoformat()
+        "lastUpdated": datetime.now().isoformat(),
+        "isTestData": True
     }
     
     save_gifts_data(gifts_data)
-    logger.info(f"Создано {len(test_gifts)} тестовых подарков")
+    logger.info("Создано %s тестовых подарков", len(test_gifts))
     
     return gifts_data
 
-# Преобразование объекта Gift в словарь для JSON
-def gift_to_dict(gift):
+# Получение подарков через API (с кэшированием)
+def fetch_gifts(collection=None):
+    if collection:
+        # Получаем подарки из указанной коллекции
+        gifts_list = upstream_cache.get(
+            ('gifts', collection),
+            lambda: fragment_client.get_gifts_by_collection(collection)
+        )
+    else:
+        # Получаем все подарки
+        gifts_list = upstream_cache.get(
+            ('gifts', None),
+            fragment_client.get_all_gifts
+        )
+    
+    # Преобразуем в словари пакетно
+    return normalize_gifts(gifts_list)
+
+# Фильтрация подарков по статусу
+def filter_by_status(gifts, status):
+    statuses = STATUS_GROUPS.get(status)
+    if statuses is None:
+        return gifts
+    return [gift for gift in gifts if gift['status'] in statuses]
+
+# Максимальный размер страницы (параметр limit)
+MAX_PAGE_SIZE = int(os.getenv("FRAGMENT_MAX_PAGE_SIZE", "500"))
+
+# Разбор параметров сортировки, постраничного вывода и выборки полей
+def parse_list_params(args):
+    sort = args.get('sort') or None
+    if sort and sort.lstrip('-') not in SORT_KEYS:
+        raise ValueError(f"Unsupported sort: {sort}")
+    
+    try:
+        offset = int(args.get('offset') or 0)
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError:
+        raise ValueError("offset and limit must be integers")
+    
+    if offset < 0:
+        raise ValueError("offset must be non-negative")
+    
+    # При limit=0 nextOffset не продвигался бы, и клиент запрашивал бы одну и ту же страницу
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be a positive integer")
+    
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_SIZE)
+    
+    fields = [field.strip() for field in (args.get('fields') or '').split(',') if field.strip()]
+    
     return {
-        "id": str(gift.get('id', '0')),
-        "name": gift.get('name', 'Unknown'),
-        "owner": gift.get('owner', 'unknown'),
-        "collection": gift.get('collection', 'Unknown'),
-        "status": gift.get('status', 'not_for_sale'),
-        "price": {
-            "amount": str(gift.get('price', 0)),
-            "currency": "TON"
-        },
-        "model": {
-            "name": gift.get('model', {}).get('name', 'Unknown'),
-            "rarity": f"{gift.get('model', {}).get('rarity', 0):.1f}%"
-        },
-        "background": {
-            "name": gift.get('background', {}).get('name', 'Unknown'),
-            "rarity": f"{gift.get('background', {}).get('rarity', 0):.1f}%"
-        },
-        "symbol": {
-            "name": gift.get('symbol', {}).get('name', 'Unknown'),
-            "rarity": f"{gift.get('symbol', {}).get('rarity', 0):.1f}%"
+        "sort": sort,
+        "offset": offset,
+        "limit": limit,
+        "fields": fields or None,
+        "paginated": 'offset' in args or 'limit' in args
+    }
+
+# Формирование ответа со страницей подарков
+def gifts_payload(gifts, params, last_updated):
+    offset, limit = params["offset"], params["limit"]
+    total = len(gifts)
+    
+    if params["paginated"]:
+        end = total if limit is None else min(offset + limit, total)
+        page = gifts[offset:end]
+    else:
+        page = gifts
+    
+    if params["fields"]:
+        page = project_gifts(page, params["fields"])
+    
+    payload = {
+        "success": True,
+        "gifts": page,
+        "lastUpdated": last_updated
+    }
+    
+    if params["paginated"]:
+        payload.update({
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "nextOffset": end if end < total else None
+        })
+    
+    return payload
+
+# Кэш сериализованных ответов по версии снимка каталога
+response_cache = ResponseCache(max_entries=int(os.getenv("FRAGMENT_RESPONSE_CACHE_SIZE", "256")))
+
+# Минимальный размер тела ответа для сжатия gzip
+GZIP_MIN_SIZE = 1024
+
+# Преобразование lastUpdated в дату для заголовка Last-Modified
+def last_modified_from(last_updated):
+    if not last_updated:
+        return None
+    try:
+        return datetime.fromisoformat(last_updated).astimezone(timezone.utc).replace(microsecond=0)
+    except ValueError:
+        return None
+
+# Сериализация ответа в том же виде, что и jsonify
+def serialize_payload(payload, last_updated=None):
+    body = (app.json.dumps(payload) + "\n").encode('utf-8')
+    return CachedResponse(body, last_modified_from(last_updated))
+
+# Ответ с готовым телом, ETag/Last-Modified и поддержкой 304 Not Modified
+def conditional_response(entry):
+    use_gzip = len(entry.body) >= GZIP_MIN_SIZE and request.accept_encodings['gzip'] > 0
+    etag = f"{entry.etag}-gzip" if use_gzip else entry.etag
+    
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = (entry.last_modified is not None and request.if_modified_since is not None
+                        and entry.last_modified <= request.if_modified_since)
+    
+    if not_modified:
+        response = Response(status=304)
+    else:
+        response = Response(entry.gzip_body if use_gzip else entry.body, mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    
+    response.set_etag(etag)
+    if entry.last_modified is not None:
+        response.last_modified = entry.last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Ответ по текущему снимку каталога (тело кэшируется до смены снимка)
+def snapshot_response(build_payload):
+    key = (request.path, tuple(sorted(request.args.items(multi=True))))
+    entry = response_cache.get(
+        gift_catalog.version,
+        key,
+        lambda: serialize_payload(build_payload(), gift_catalog.snapshot()["lastUpdated"])
+    )
+    return conditional_response(entry)
+
+# Загрузка полного каталога для фонового обновления
+def fetch_catalog():
+    all_gifts = fragment_client.get_all_gifts()
+    return normalize_catalog(all_gifts)
+
+# Публикация нового снимка каталога
+def publish_catalog(gifts_data):
+    save_gifts_data(gifts_data)
+    # Сбрасываем кэш, чтобы запросы к API получили свежие данные
+    upstream_cache.invalidate()
+
+# Фоновое обновление каталога
+catalog_refresher = CatalogRefresher(
+    fetch_catalog,
+    publish_catalog,
+    interval=float(os.getenv("FRAGMENT_REFRESH_INTERVAL", "60")),
+    max_backoff=float(os.getenv("FRAGMENT_REFRESH_MAX_BACKOFF", "600"))
+)
+
+# Путь к журналу покупок
+PURCHASES_DB_PATH = os.getenv("FRAGMENT_PURCHASES_DB", os.path.join(os.path.dirname(__file__), 'fragment_purchases.db'))
+
+# Очередь покупок с журналом в SQLite
+# (незавершенные покупки других процессов подхватываются только при запуске сервера, см. warm_up)
+purchase_queue = PurchaseQueue(
+    PurchaseJournal(PURCHASES_DB_PATH),
+    fragment_client.buy_gift,
+    workers=int(os.getenv("FRAGMENT_PURCHASE_WORKERS", "4")),
+    max_pending=int(os.getenv("FRAGMENT_PURCHASE_MAX_PENDING", "100")),
+    retry_delay=float(os.getenv("FRAGMENT_PURCHASE_RETRY_DELAY", "0.5"))
+)
+
+# Пакетный запрос подарков: максимум ID в запросе, число одновременных вызовов API и общий таймаут
+BATCH_MAX_IDS = int(os.getenv("FRAGMENT_BATCH_MAX_IDS", "100"))
+BATCH_TIMEOUT = float(os.getenv("FRAGMENT_BATCH_TIMEOUT", "10"))
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FRAGMENT_BATCH_CONCURRENCY", "8")),
+    thread_name_prefix="gift-batch"
+)
+
+# Получение подарка по ID через API для пакетного запроса
+# (возвращается не позже срока deadline, зависший вызов API доработает вне пула batch_executor)
+def fetch_gift_by_id(gift_id, deadline):
+    gift = fragment_client.get_gift_by_id(gift_id, deadline=deadline)
+    return gift_to_dict(gift) if gift else None
+
+# Максимальное время ожидания обновления в /api/fragment/update
+UPDATE_TIMEOUT = float(os.getenv("FRAGMENT_UPDATE_TIMEOUT", "30"))
+
+# Значения счетчиков вызовов Fragment API по каждой функции
+def upstream_call_stats(field):
+    return [({"call": name}, stats[field]) for name, stats in fragment_client.stats()["calls"].items()]
+
+# Возраст текущего снимка каталога в секундах
+def snapshot_age():
+    last_modified = last_modified_from(gift_catalog.snapshot()["lastUpdated"])
+    if last_modified is None:
+        return None
+    return (datetime.now(timezone.utc) - last_modified).total_seconds()
+
+# Размер файлов каталога в байтах
+def snapshot_sizes():
+    return [({"file": name}, os.path.getsize(path))
+            for name, path in (("catalog_db", CATALOG_DB_PATH), ("json_export", GIFTS_DATA_PATH))
+            if os.path.exists(path)]
+
+metrics.counter_from('fragment_upstream_calls_total', 'Fragment API calls', lambda: upstream_call_stats("calls"))
+metrics.counter_from('fragment_upstream_errors_total', 'Failed Fragment API calls', lambda: upstream_call_stats("errors"))
+metrics.counter_from('fragment_upstream_retries_total', 'Retried Fragment API calls', lambda: upstream_call_stats("retries"))
+metrics.counter_from(
+    'fragment_upstream_rejected_total', 'Fragment API calls rejected by the open circuit breaker',
+    lambda: upstream_call_stats("rejected")
+)
+metrics.gauge(
+    'fragment_upstream_circuit_state', 'Circuit breaker state (1 for the current state)',
+    lambda: [({"state": state}, int(fragment_client.breaker.state == state)) for state in ('closed', 'open', 'half_open')]
+)
+metrics.counter_from(
+    'fragment_upstream_cache_requests_total', 'Fragment API result cache lookups by result',
+    lambda: [({"result": result}, count) for result, count in upstream_cache.stats.items()]
+)
+metrics.counter_from(
+    'fragment_response_cache_requests_total', 'Serialized response cache lookups by result',
+    lambda: [({"result": result}, count) for result, count in response_cache.stats.items()]
+)
+metrics.gauge('fragment_snapshot_age_seconds', 'Age of the current catalog snapshot', snapshot_age)
+metrics.gauge('fragment_snapshot_gifts', 'Number of gifts in the current catalog snapshot', lambda: len(gift_catalog))
+metrics.gauge('fragment_snapshot_bytes', 'Size of the catalog files', snapshot_sizes)
+metrics.gauge(
+    'fragment_refresh_consecutive_failures', 'Consecutive failed catalog refreshes',
+    lambda: catalog_refresher.failures
+)
+metrics.gauge('fragment_purchase_queue_pending', 'Purchases waiting or in progress in this process',
+              lambda: purchase_queue.pending)
+metrics.gauge(
+    'fragment_purchases', 'Purchases in the journal by status',
+    lambda: [({"status": status}, count) for status, count in purchase_queue.journal.counts().items()]
+)
+
+# Время запуска процесса и состояние прогрева каталога
+BOOT_TIME = time.time()
+warm_up_state = {"started": None, "finished": None, "duration": None, "error": None}
+warm_up_lock = threading.Lock()
+
+# Прогрев каталога из последнего снимка (выполняется в фоновом потоке)
+def warm_up():
+    started = time.perf_counter()
+    
+    # Покупки завершившихся процессов продолжает только запущенный сервер, а не любой импорт модуля
+    try:
+        purchase_queue.recover()
+    except Exception as e:
+        logger.error("Ошибка при восстановлении очереди покупок: %s", e)
+    
+    try:
+        import_json_snapshot()
+        
+        # Первый запуск без данных: тестовые данные, пока фоновое обновление не получит каталог
+        if not len(catalog_store):
+            create_test_data()
+        
+        # Загружаем снимок из хранилища и строим индексы до первых запросов
+        gift_catalog.snapshot()
+        logger.info("Каталог прогрет за %.3f с: %s подарков", time.perf_counter() - started, len(gift_catalog))
+    except Exception as e:
+        warm_up_state["error"] = str(e)
+        logger.error("Ошибка при прогреве каталога: %s", e)
+    finally:
+        warm_up_state["duration"] = round(time.perf_counter() - started, 3)
+        warm_up_state["finished"] = datetime.now().isoformat()
+        # Фоновое обновление запускается после прогрева, чтобы не конкурировать с ним за снимок
+        catalog_refresher.start()
+
+# Запуск прогрева (повторные вызовы ничего не делают)
+def start_warm_up():
+    with warm_up_lock:
+        if warm_up_state["started"] is not None:
+            return
+        warm_up_state["started"] = datetime.now().isoformat()
+    threading.Thread(target=warm_up, name="catalog-warm-up", daemon=True).start()
+
+# Запускаем прогрев и фоновое обновление при первом запросе к серверу
+@app.before_request
+def start_catalog_refresher():
+    start_warm_up()
+
+# Замер времени обработки запроса и привязка ID запроса к логам
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID') or new_request_id()
+    g.log_tokens = bind_request(g.request_id, log_sampler.sampled(request.endpoint))
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        request_latency.observe(
+            time.perf_counter() - started,
+            route=request.endpoint or 'not_found',
+            method=request.method,
+            status=response.status_code
+        )
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def release_request_context(error=None):
+    tokens = g.pop('log_tokens', None)
+    if tokens is not None:
+        unbind_request(tokens)
+
+# Состояние процесса для супервизоров: 200, когда каталог прогрет, иначе 503
+@app.route('/api/fragment/health', methods=['GET'])
+def get_health():
+    finished = warm_up_state["finished"] is not None
+    failed = finished and warm_up_state["error"] is not None
+    ready = finished and not failed
+    
+    payload = {
+        "success": True,
+        "status": "error" if failed else "ready" if ready else "warming",
+        "ready": ready,
+        "uptime": round(time.time() - BOOT_TIME, 3),
+        "warmUp": dict(warm_up_state),
+        "upstream": {
+            "loaded": fragment_client.loaded,
+            "httpTimeouts": fragment_client.http_timeouts,
+            "abandonedCalls": fragment_client.abandoned,
+            "circuit": fragment_client.breaker.state
         },
-        "supply": gift.get('supply', 'Unknown'),
-        "image": gift.get('image', f"https://via.placeholder.com/300x300?text={gift.get('name', 'Unknown')}"),
-        "animatedImage": gift.get('animated_image'),
-        "url": gift.get('url', f"https://fragment.com/gift/{gift.get('id', '0')}")
+        "refresher": {
+            "running": catalog_refresher.running,
+            "lastSuccess": catalog_refresher.last_success,
+            "failures": catalog_refresher.failures
+        }
     }
+    
+    # Пока идет прогрев, каталог не трогаем: его загрузка держит блокировку
+    if finished:
+        payload["catalog"] = {
+            "gifts": len(gift_catalog),
+            "version": gift_catalog.version,
+            "lastUpdated": gift_catalog.snapshot()["lastUpdated"]
+        }
+    
+    return jsonify(payload), 200 if ready else 503
+
+# Метрики в формате Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Маршрут для получения списка подарков
 @app.route('/api/fragment/gifts', methods=['GET'])
@@ -168,86 +601,166 @@ def get_gifts():
         collection = request.args.get('collection')
         status = request.args.get('status', 'all')
         
-        logger.info(f"Запрос на получение подарков (коллекция: {collection}, статус: {status})")
+        logger.info("Запрос на получение подарков (коллекция: %s, статус: %s)", collection, status)
         
         try:
-            # Пытаемся получить подарки через API
-            gifts = []
-            
-            try:
-                # Получаем все подарки
-                if collection:
-                    # Получаем подарки из указанной коллекции
-                    gifts_list = fragment.get_gifts_by_collection(fragment_client, collection)
-                else:
-                    # Получаем все подарки
-                    gifts_list = fragment.get_all_gifts(fragment_client)
-                
-                # Преобразуем в словари
-                gifts = [gift_to_dict(gift) for gift in gifts_list]
-                
-                # Фильтруем по статусу, если указан
-                if status != 'all':
-                    if status == 'for_sale':
-                        gifts = [gift for gift in gifts if gift['status'] == 'for_sale']
-                    elif status == 'on_auction':
-                        gifts = [gift for gift in gifts if gift['status'] == 'on_auction']
-                    elif status == 'available':
-                        gifts = [gift for gift in gifts if gift['status'] in ['for_sale', 'on_auction']]
-            except Exception as api_error:
-                logger.error(f"Ошибка при вызове API ton_fragment: {api_error}")
-                # Создаем тестовые данные
-                gifts = []
+            params = parse_list_params(request.args)
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 400
+        
+        # Если каталог уже загружен, отдаем последний снимок
+        if snapshot_ready():
+            return snapshot_response(lambda: gifts_payload(
+                gift_catalog.query(collection, status, params["sort"]),
+                params,
+                gift_catalog.snapshot()["lastUpdated"]
+            ))
+        
+        try:
+            # Каталог еще не загружен, получаем подарки через API
+            gifts = filter_by_status(fetch_gifts(collection), status)
+            if params["sort"]:
+                gifts = sort_gifts(gifts, params["sort"])
             
-            # Сохраняем данные в файл
-            gifts_data = {
-                "gifts": gifts,
-                "lastUpdated": datetime.now().isoformat()
-            }
-            save_gifts_data(gifts_data)
+            logger.info("Получено %s подарков", len(gifts))
             
-            logger.info(f"Получено {len(gifts)} подарков")
-            
-            return jsonify({
-                "success": True,
-                "gifts": gifts,
-                "lastUpdated": gifts_data["lastUpdated"]
-            })
+            return jsonify(gifts_payload(gifts, params, datetime.now().isoformat()))
             
         except Exception as api_error:
-            logger.error(f"Ошибка при получении подарков через API: {api_error}")
+            logger.error("Ошибка при получении подарков через API: %s", api_error)
             
-            # Пробуем загрузить из файла
-            gifts_data = load_gifts_data()
+            # Если в каталоге нет данных, создаем тестовые
+            if not len(gift_catalog):
+                create_test_data()
             
-            # Если в файле нет данных, создаем тестовые
-            if not gifts_data["gifts"]:
-                gifts_data = create_test_data()
+            # Фильтруем по коллекции и статусу по индексам каталога
+            gifts = gift_catalog.query(collection, status, params["sort"])
             
-            # Фильтруем по коллекции, если указана
-            if collection:
-                gifts_data["gifts"] = [gift for gift in gifts_data["gifts"] if gift.get("collection") == collection]
+            logger.info("Загружено %s подарков из кэша", len(gifts))
             
-            # Фильтруем по статусу, если указан
-            if status != 'all':
-                if status == 'for_sale':
-                    gifts_data["gifts"] = [gift for gift in gifts_data["gifts"] if gift.get("status") == 'for_sale']
-                elif status == 'on_auction':
-                    gifts_data["gifts"] = [gift for gift in gifts_data["gifts"] if gift.get("status") == 'on_auction']
-                elif status == 'available':
-                    gifts_data["gifts"] = [gift for gift in gifts_data["gifts"] if gift.get("status") in ['for_sale', 'on_auction']]
+            payload = gifts_payload(gifts, params, gift_catalog.snapshot()["lastUpdated"])
+            payload["fromCache"] = True
+            count_fallback('fromCache')
+            return jsonify(payload)
+    
+    except Exception as e:
+        logger.error("Ошибка при обработке запроса: %s", e)
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+# Поток изменений (Server-Sent Events) обслуживается только в режиме ASGI (fragment_asgi.py),
+# чтобы не занимать поток на каждое подключение
+@app.route('/api/fragment/gifts/stream', methods=['GET'])
+def stream_gift_changes():
+    return jsonify({
+        "success": False,
+        "error": "Change stream is available only in ASGI mode"
+    }), 501
+
+# Маршрут для получения изменений каталога после указанной версии
+@app.route('/api/fragment/gifts/changes', methods=['GET'])
+def get_gift_changes():
+    try:
+        since = request.args.get('since')
+        
+        logger.info("Запрос на получение изменений каталога (версия: %s)", since)
+        
+        def build_payload():
+            changes = gift_catalog.changes_since(since)
+            if changes["full"] and since:
+                logger.info("Версия %s недоступна в журнале изменений, отдаем полный снимок", since)
+            return {"success": True, "since": since, **changes}
+        
+        return snapshot_response(build_payload)
+    except Exception as e:
+        logger.error("Ошибка при обработке запроса: %s", e)
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+# Маршрут для получения нескольких подарков по списку ID
+@app.route('/api/fragment/gifts/batch', methods=['POST'])
+def get_gifts_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        
+        if not isinstance(ids, list) or not ids:
+            return jsonify({
+                "success": False,
+                "error": "ids must be a non-empty list"
+            }), 400
+        
+        # Убираем повторы, сохраняя порядок
+        ids = list(dict.fromkeys(str(gift_id) for gift_id in ids))
+        
+        if len(ids) > BATCH_MAX_IDS:
+            return jsonify({
+                "success": False,
+                "error": f"Too many ids (max {BATCH_MAX_IDS})"
+            }), 400
+        
+        logger.info("Пакетный запрос %s подарков", len(ids))
+        
+        # Сначала ищем подарки в снимке каталога (как и для одного подарка, только если снимок загружен)
+        results = {}
+        if snapshot_ready():
+            for gift_id in ids:
+                gift = gift_catalog.get(gift_id)
+                if gift:
+                    results[gift_id] = {"id": gift_id, "success": True, "gift": gift, "source": "snapshot"}
+        
+        # Остальные запрашиваем через API параллельно (не больше FRAGMENT_BATCH_CONCURRENCY вызовов)
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        futures = {
+            batch_executor.submit(fetch_gift_by_id, gift_id, deadline): gift_id
+            for gift_id in ids if gift_id not in results
+        }
+        
+        if futures:
+            done, not_done = wait(futures, timeout=BATCH_TIMEOUT)
             
-            logger.info(f"Загружено {len(gifts_data['gifts'])} подарков из файла")
+            # Невыполненные вызовы снимаются с очереди, а начатые вернут управление не позже срока deadline
+            for future in not_done:
+                future.cancel()
             
-            return jsonify({
-                "success": True,
-                "gifts": gifts_data["gifts"],
-                "lastUpdated": gifts_data["lastUpdated"],
-                "fromCache": True
-            })
+            for future, gift_id in futures.items():
+                if future in done:
+                    try:
+                        gift = future.result()
+                        error = None if gift else "Gift not found"
+                    except Exception as api_error:
+                        logger.error("Ошибка при получении подарка %s через API: %s", gift_id, api_error)
+                        gift, error = None, str(api_error)
+                else:
+                    gift, error = None, "Request timed out"
+                
+                if gift:
+                    results[gift_id] = {"id": gift_id, "success": True, "gift": gift, "source": "api"}
+                    continue
+                
+                # Если через API получить подарок не удалось, ищем его в каталоге
+                cached = gift_catalog.get(gift_id)
+                if cached:
+                    count_fallback('fromCache')
+                    results[gift_id] = {"id": gift_id, "success": True, "gift": cached, "fromCache": True}
+                else:
+                    results[gift_id] = {"id": gift_id, "success": False, "error": error}
+        
+        return jsonify({
+            "success": True,
+            "results": [results[gift_id] for gift_id in ids],
+            "found": sum(1 for result in results.values() if result["success"])
+        })
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
+        logger.error("Ошибка при обработке запроса: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -257,12 +770,19 @@ def get_gifts():
 @app.route('/api/fragment/gifts/<gift_id>', methods=['GET'])
 def get_gift_by_id(gift_id):
     try:
-        logger.info(f"Запрос на получение подарка с ID: {gift_id}")
+        logger.info("Запрос на получение подарка с ID: %s", gift_id)
+        
+        # Сначала ищем подарок в последнем снимке каталога
+        if snapshot_ready() and gift_catalog.get(gift_id):
+            return snapshot_response(lambda: {
+                "success": True,
+                "gift": gift_catalog.get(gift_id)
+            })
         
         try:
             # Пытаемся получить подарок через API
             try:
-                gift = fragment.get_gift_by_id(fragment_client, gift_id)
+                gift = fragment_client.get_gift_by_id(gift_id)
                 if gift:
                     gift_data = gift_to_dict(gift)
                     return jsonify({
@@ -270,13 +790,13 @@ def get_gift_by_id(gift_id):
                         "gift": gift_data
                     })
             except Exception as api_error:
-                logger.error(f"Ошибка при получении подарка через API: {api_error}")
+                logger.error("Ошибка при получении подарка через API: %s", api_error)
                 
-            # Если подарок не найден через API или произошла ошибка, ищем в файле
-            gifts_data = load_gifts_data()
-            gift_data = next((gift for gift in gifts_data["gifts"] if gift["id"] == gift_id), None)
+            # Если подарок не найден через API или произошла ошибка, ищем в каталоге
+            gift_data = gift_catalog.get(gift_id)
             
             if gift_data:
+                count_fallback('fromCache')
                 return jsonify({
                     "success": True,
                     "gift": gift_data,
@@ -289,13 +809,13 @@ def get_gift_by_id(gift_id):
                 }), 404
         
         except Exception as api_error:
-            logger.error(f"Ошибка при получении подарка через API: {api_error}")
+            logger.error("Ошибка при получении подарка через API: %s", api_error)
             
-            # Ищем в файле
-            gifts_data = load_gifts_data()
-            gift_data = next((gift for gift in gifts_data["gifts"] if gift["id"] == gift_id), None)
+            # Ищем в каталоге
+            gift_data = gift_catalog.get(gift_id)
             
             if gift_data:
+                count_fallback('fromCache')
                 return jsonify({
                     "success": True,
                     "gift": gift_data,
@@ -308,7 +828,7 @@ def get_gift_by_id(gift_id):
                 }), 404
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
+        logger.error("Ошибка при обработке запроса: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -322,40 +842,49 @@ def get_collections():
         
         try:
             # Пытаемся получить коллекции через API
-            collections = fragment.get_all_collections(fragment_client)
-            collections_data = [{"id": str(col.get('id', i)), "name": col.get('name', f'Collection {i}')}
-                               for i, col in enumerate(collections)]
+            collections = upstream_cache.get(
+                ('collections', None),
+                fragment_client.get_all_collections
+            )
+            # Показатели коллекций берутся из снимка каталога, где они уже посчитаны
+            stats = gift_catalog.collection_stats()
+            collections_data = []
+            for i, col in enumerate(collections):
+                name = col.get('name', f'Collection {i}')
+                collections_data.append({
+                    "id": str(col.get('id', i)),
+                    "name": name,
+                    **(stats.get(name) or empty_collection_stats())
+                })
             
-            logger.info(f"Получено {len(collections_data)} коллекций")
+            logger.info("Получено %s коллекций", len(collections_data))
             
-            return jsonify({
+            # Список коллекций небольшой, поэтому тело не кэшируется, но ETag позволяет ответить 304
+            return conditional_response(serialize_payload({
                 "success": True,
-                "collections": collections_data
-            })
+                "collections": collections_data,
+                "lastUpdated": gift_catalog.snapshot()["lastUpdated"]
+            }))
         
         except Exception as api_error:
-            logger.error(f"Ошибка при получении коллекций через API: {api_error}")
+            logger.error("Ошибка при получении коллекций через API: %s", api_error)
             
-            # Извлекаем уникальные коллекции из файла с подарками
-            gifts_data = load_gifts_data()
-            collections_set = set()
+            # Берем коллекции и их показатели из снимка каталога
+            stats = gift_catalog.collection_stats()
+            collections_data = [{"id": i, "name": name, **stats[name]} for i, name in enumerate(sorted(stats))]
             
-            for gift in gifts_data["gifts"]:
-                if "collection" in gift and gift["collection"]:
-                    collections_set.add(gift["collection"])
-            
-            collections_data = [{"id": i, "name": name} for i, name in enumerate(sorted(collections_set))]
-            
-            logger.info(f"Извлечено {len(collections_data)} коллекций из кэша")
+            logger.info("Извлечено %s коллекций из кэша", len(collections_data))
             
+            count_fallback('fromCache')
             return jsonify({
                 "success": True,
                 "collections": collections_data,
+                "lastUpdated": gift_catalog.snapshot()["lastUpdated"],
                 "fromCache": True
             })
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
+        logger.error("Ошибка при обработке запроса: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -367,54 +896,50 @@ def update_gifts():
     try:
         logger.info("Запрос на обновление данных подарков")
         
-        try:
-            # Получаем все подарки через API
-            try:
-                all_gifts = fragment.get_all_gifts(fragment_client)
-                gifts = [gift_to_dict(gift) for gift in all_gifts]
-                
-                # Сохраняем данные в файл
-                gifts_data = {
-                    "gifts": gifts,
-                    "lastUpdated": datetime.now().isoformat()
-                }
-                save_gifts_data(gifts_data)
-                
-                logger.info(f"Обновлено {len(gifts)} подарков")
-                
-                return jsonify({
-                    "success": True,
-                    "message": f"Updated {len(gifts)} gifts",
-                    "lastUpdated": gifts_data["lastUpdated"]
-                })
-            except Exception as api_error:
-                logger.error(f"Ошибка при обновлении подарков через API: {api_error}")
-                # Создаем тестовые данные
-                gifts_data = create_test_data()
-                
-                return jsonify({
-                    "success": True,
-                    "message": f"Created {len(gifts_data['gifts'])} test gifts due to API error",
-                    "lastUpdated": gifts_data["lastUpdated"],
-                    "isTestData": True,
-                    "error": str(api_error)
-                })
+        # Запускаем внеочередное обновление и ждем его результата
+        result = catalog_refresher.trigger(wait=True, timeout=UPDATE_TIMEOUT)
         
-        except Exception as api_error:
-            logger.error(f"Ошибка при обновлении подарков через API: {api_error}")
-            
-            # Создаем тестовые данные
+        if result is None:
+            return jsonify({
+                "success": True,
+                "message": "Update scheduled",
+                "lastUpdated": gift_catalog.snapshot()["lastUpdated"],
+                "pending": True
+            }), 202
+        
+        if result["success"]:
+            return jsonify({
+                "success": True,
+                "message": f"Updated {result['count']} gifts",
+                "lastUpdated": result["lastUpdated"]
+            })
+        
+        logger.error("Ошибка при обновлении подарков через API: %s", result['error'])
+        
+        # Создаем тестовые данные, если каталог пуст
+        if not len(gift_catalog):
             gifts_data = create_test_data()
             
+            count_fallback('isTestData')
             return jsonify({
                 "success": True,
-                "message": f"Created {len(gifts_data['gifts'])} test gifts",
+                "message": f"Created {len(gifts_data['gifts'])} test gifts due to API error",
                 "lastUpdated": gifts_data["lastUpdated"],
-                "isTestData": True
+                "isTestData": True,
+                "error": result["error"]
             })
+        
+        count_fallback('fromCache')
+        return jsonify({
+            "success": True,
+            "message": f"Kept {len(gift_catalog)} cached gifts due to API error",
+            "lastUpdated": gift_catalog.snapshot()["lastUpdated"],
+            "fromCache": True,
+            "error": result["error"]
+        })
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
+        logger.error("Ошибка при обработке запроса: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -440,44 +965,59 @@ def buy_gift():
                 "error": "Recipient is required"
             }), 400
         
-        logger.info(f"Запрос на покупку подарка с ID: {gift_id} для получателя: {recipient}")
+        # Ключ идемпотентности: повторный запрос с тем же ключом не покупает подарок снова
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+        
+        logger.info("Запрос на покупку подарка с ID: %s для получателя: %s", gift_id, recipient)
         
         try:
-            # Пытаемся купить подарок через API
-            try:
-                result = fragment.buy_gift(fragment_client, gift_id, recipient)
-                
-                if result and result.get('success'):
-                    return jsonify({
-                        "success": True,
-                        "message": f"Gift {gift_id} successfully purchased and sent to {recipient}",
-                        "transactionId": result.get('transaction_id', 'unknown')
-                    })
-                else:
-                    return jsonify({
-                        "success": False,
-                        "error": result.get('error', 'Unknown error')
-                    }), 400
-            except Exception as api_error:
-                logger.error(f"Ошибка при покупке подарка через API: {api_error}")
-                return jsonify({
-                    "success": False,
-                    "error": str(api_error)
-                }), 400
+            job, created = purchase_queue.submit(str(gift_id), recipient, idempotency_key)
+        except IdempotencyConflictError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 409
+        except QueueFullError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 503
         
-        except Exception as api_error:
-            logger.error(f"Ошибка при покупке подарка через API: {api_error}")
-            
-            # Симулируем успешную покупку для тестирования
+        return jsonify({
+            "success": True,
+            "message": f"Purchase of gift {gift_id} for {recipient} queued" if created
+                       else f"Purchase of gift {gift_id} for {recipient} already exists",
+            "jobId": job["jobId"],
+            "status": job["status"],
+            "statusUrl": f"/api/fragment/buy/{job['jobId']}"
+        }), 202 if created else 200
+    
+    except Exception as e:
+        logger.error("Ошибка при обработке запроса: %s", e)
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+# Маршрут для получения состояния покупки
+@app.route('/api/fragment/buy/<job_id>', methods=['GET'])
+def get_purchase(job_id):
+    try:
+        job = purchase_queue.get(job_id)
+        
+        if not job:
             return jsonify({
-                "success": True,
-                "message": f"Simulated purchase of gift {gift_id} for {recipient}",
-                "transactionId": "test_transaction_" + datetime.now().strftime("%Y%m%d%H%M%S"),
-                "isSimulated": True
-            })
+                "success": False,
+                "error": "Purchase not found"
+            }), 404
+        
+        return jsonify({
+            "success": True,
+            "job": job
+        })
     
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса: {e}")
+        logger.error("Ошибка при обработке запроса: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -485,9 +1025,11 @@ def buy_gift():
 
 # Запуск приложения
 if __name__ == '__main__':
-    # Создаем тестовые данные при первом запуске, если файл не существует
-    if not os.path.exists(GIFTS_DATA_PATH):
-        create_test_data()
+    # Каталог прогревается в фоне, сервер принимает запросы сразу.
+    # В режиме debug родительский процесс перезагрузчика werkzeug запросы не обслуживает,
+    # прогрев запускается только в дочернем процессе (WERKZEUG_RUN_MAIN=true)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_warm_up()
     
     # Запускаем приложение
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Кэш ответов Fragment API
+TTL + stale-while-revalidate кэш с LRU-вытеснением и объединением одновременных запросов,
+а также кэш сериализованных ответов API
+"""
+
+import gzip
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """Загрузка значения, выполняющаяся в данный момент (single-flight)."""
+
+    def __init__(self, generation):
+        self.done = threading.Event()
+        # Поколение кэша на момент запуска загрузки
+        self.generation = generation
+        self.value = None
+        self.error = None
+
+
+class UpstreamCache:
+    """
+    Кэш результатов вызовов ton_fragment по ключу (endpoint, collection).
+
+    - Пока запись свежая (моложе ttl), она отдается без обращения к API.
+    - Устаревшая запись (моложе stale_ttl) отдается сразу, а обновление
+      запускается в фоновом потоке.
+    - Одновременные промахи по одному ключу выполняют один вызов API.
+    - При превышении max_entries вытесняется давно не использованная запись.
+    - Загрузки, начатые до invalidate(), не записывают результат в кэш.
+    """
+
+    def __init__(self, ttl=60, stale_ttl=600, max_entries=128):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "errors": 0}
+
+    # Сохранение значения с вытеснением старых записей (вызывается под self._lock)
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Выполнение загрузки и публикация результата ожидающим потокам
+    def _run_flight(self, key, flight, loader):
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+
+        with self._lock:
+            if self._inflight.get(key) is flight:
+                self._inflight.pop(key)
+            if flight.error is not None:
+                self.stats["errors"] += 1
+            elif flight.generation == self._generation:
+                # Результат загрузки, начатой до invalidate(), в кэш не попадает
+                self._store(key, flight.value)
+        flight.done.set()
+
+    # Фоновое обновление устаревшей записи
+    def _refresh_in_background(self, key, flight, loader):
+        def run():
+            self._run_flight(key, flight, loader)
+            if flight.error is not None:
+                logger.error("Ошибка при фоновом обновлении кэша %s: %s", key, flight.error)
+
+        threading.Thread(target=run, name=f"cache-refresh-{key[0]}", daemon=True).start()
+
+    # Получение значения из кэша или загрузка через loader
+    def get(self, key, loader):
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+
+                if age < self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["stale"] += 1
+                    if key not in self._inflight:
+                        flight = _Flight(self._generation)
+                        self._inflight[key] = flight
+                        self._refresh_in_background(key, flight, loader)
+                    return value
+
+            self.stats["misses"] += 1
+            flight = self._inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = _Flight(self._generation)
+                self._inflight[key] = flight
+
+        if owner:
+            self._run_flight(key, flight, loader)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    # Сброс записи или всего кэша вместе с начатыми загрузками
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+                self._inflight.clear()
+            else:
+                self._entries.pop(key, None)
+                self._inflight.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class CachedResponse:
+    """Сериализованное тело ответа вместе с ETag и сжатой копией."""
+
+    def __init__(self, body, last_modified=None):
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.last_modified = last_modified
+        self._gzip_body = None
+
+    # Сжатое тело ответа (сжимается один раз при первом запросе)
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, compresslevel=6)
+        return self._gzip_body
+
+
+class ResponseCache:
+    """
+    Кэш сериализованных ответов по версии снимка каталога и параметрам запроса.
+
+    При смене версии снимка все записи предыдущей версии удаляются.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self.stats = {"hits": 0, "misses": 0}
+
+    # Получение ответа из кэша или его построение через build()
+    def get(self, version, key, build):
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+
+        entry = build()
+
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return entry
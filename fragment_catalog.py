@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Каталог подарков Fragment
+Резидентный в памяти процесса каталог с индексами по ID, коллекции и статусу,
+а также запись снимков каталога в JSON файл
+"""
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+import statistics
+
+logger = logging.getLogger(__name__)
+
+# Группы статусов, которые можно передать в параметре status
+STATUS_GROUPS = {
+    'for_sale': ('for_sale',),
+    'on_auction': ('on_auction',),
+    'available': ('for_sale', 'on_auction'),
+}
+
+
+# Ключ сортировки по цене
+def price_value(gift):
+    price = gift.get('price')
+    if isinstance(price, dict):
+        price = price.get('amount')
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        return None
+
+
+# Ключ сортировки по редкости модели ("1.5%" -> 1.5)
+def rarity_value(gift):
+    model = gift.get('model')
+    if not isinstance(model, dict):
+        return None
+    try:
+        return float(str(model.get('rarity')).rstrip('%'))
+    except (TypeError, ValueError):
+        return None
+
+
+# Поддерживаемые ключи сортировки (префикс "-" означает убывание)
+SORT_KEYS = {
+    'price': price_value,
+    'rarity': rarity_value,
+}
+
+
+# Функция-ключ для сортировки по sort; подарки без значения всегда идут в конце
+def sort_key(sort):
+    descending = sort.startswith('-')
+    value_of = SORT_KEYS[sort.lstrip('-')]
+
+    def key(gift):
+        value = value_of(gift)
+        if value is None:
+            return (1, 0)
+        return (0, -value if descending else value)
+
+    return key
+
+
+# Сортировка списка подарков
+def sort_gifts(gifts, sort):
+    return sorted(gifts, key=sort_key(sort))
+
+
+# Оставляет в подарках только указанные поля
+def project_gifts(gifts, fields):
+    return [{field: gift[field] for field in fields if field in gift} for gift in gifts]
+
+
+# Формат редкости, как в подарках ("1.5%")
+def format_rarity(value):
+    return f"{value:.1f}%" if value is not None else None
+
+
+# Показатели коллекции, в которой нет подарков
+def empty_collection_stats():
+    return {
+        "giftCount": 0,
+        "forSale": 0,
+        "onAuction": 0,
+        "floorPrice": None,
+        "minRarity": None,
+        "medianRarity": None
+    }
+
+
+# Пустой снимок каталога
+def empty_snapshot():
+    return {"gifts": [], "lastUpdated": None}
+
+
+# Атомарная запись файла через временный файл и os.replace
+def _atomic_write(path, payload):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SnapshotWriter:
+    """
+    Запись снимка каталога в JSON файл.
+
+    Файл пишется в компактном виде во временный файл и подменяется через
+    os.replace, поэтому читатели никогда не видят наполовину записанный JSON.
+    Если список подарков не изменился (по хэшу содержимого), запись пропускается.
+    При compress=True рядом сохраняется сжатая копия <path>.gz.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.compress = compress
+        self.digest = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    # Отметка файла (mtime, размер) после последней записи
+    def _stat_file(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Запись снимка; возвращает False, если содержимое не изменилось
+    def write(self, gifts_data):
+        gifts = gifts_data["gifts"]
+        # Готовые JSON строки подарков (NormalizedGifts) только склеиваются
+        rows = getattr(gifts, 'json_rows', None)
+        if rows is not None:
+            gifts_json = '[' + ','.join(rows) + ']'
+        else:
+            gifts_json = json.dumps(gifts, ensure_ascii=False, separators=(',', ':'))
+        digest = hashlib.sha256(gifts_json.encode('utf-8')).hexdigest()
+
+        with self._lock:
+            # Файл мог быть перезаписан другим процессом, тогда пишем заново
+            if digest == self.digest and self._stat_file() == self._stamp:
+                return False
+
+            last_updated = json.dumps(gifts_data.get("lastUpdated"))
+            payload = f'{{"gifts":{gifts_json},"lastUpdated":{last_updated}}}'.encode('utf-8')
+
+            _atomic_write(self.path, payload)
+            if self.compress:
+                _atomic_write(f"{self.path}.gz", gzip.compress(payload, mtime=0))
+
+            self.digest = digest
+            self._stamp = self._stat_file()
+            return True
+
+
+class _CatalogState:
+    """
+    Снимок каталога вместе с индексами по ID, коллекции и статусу и
+    показателями коллекций (минимальная цена, количество на продаже и на
+    аукционе, минимальная и медианная редкость модели).
+    """
+
+    def __init__(self, data, version=None):
+        self.data = data
+        # Версия снимка: хэш содержимого или отметка файла
+        self.version = version
+        self.by_id = {}
+        self.by_collection = {}
+        self.by_status = {}
+        self.collection_stats = {}
+
+        floors = {}
+        rarities = {}
+
+        for gift in data['gifts']:
+            self.by_id[str(gift.get('id'))] = gift
+
+            status = gift.get('status')
+            if status:
+                self.by_status.setdefault(status, []).append(gift)
+
+            collection = gift.get('collection')
+            if not collection:
+                continue
+
+            self.by_collection.setdefault(collection, []).append(gift)
+
+            stats = self.collection_stats.get(collection)
+            if stats is None:
+                stats = self.collection_stats[collection] = empty_collection_stats()
+            stats["giftCount"] += 1
+
+            if status == 'for_sale':
+                stats["forSale"] += 1
+                # Минимальная цена считается только по подаркам на продаже
+                price = price_value(gift)
+                if price is not None and (collection not in floors or price < floors[collection][0]):
+                    floors[collection] = (price, gift.get('price'))
+            elif status == 'on_auction':
+                stats["onAuction"] += 1
+
+            rarity = rarity_value(gift)
+            if rarity is not None:
+                rarities.setdefault(collection, []).append(rarity)
+
+        for collection, (_, price) in floors.items():
+            self.collection_stats[collection]["floorPrice"] = price
+        for collection, values in rarities.items():
+            stats = self.collection_stats[collection]
+            stats["minRarity"] = format_rarity(min(values))
+            stats["medianRarity"] = format_rarity(statistics.median(values))
+
+        # Отсортированные представления строятся один раз на снимок
+        self._sorted = {}
+        self._sorted_lock = threading.Lock()
+
+    # Список подарков (всех или одной коллекции), отсортированный по ключу sort
+    def sorted_by(self, sort, collection=None):
+        if collection and collection not in self.by_collection:
+            return []
+
+        key = (sort, collection)
+        gifts = self._sorted.get(key)
+        if gifts is None:
+            with self._sorted_lock:
+                gifts = self._sorted.get(key)
+                if gifts is None:
+                    gifts = sort_gifts(self.by_collection[collection] if collection else self.data['gifts'], sort)
+                    self._sorted[key] = gifts
+        return gifts
+
+
+class JsonFileSource:
+    """Источник данных каталога: JSON файл (изменения определяются по mtime и размеру)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    # Отметка файла для определения изменений
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    # Загрузка файла с диска; возвращает (данные, версия)
+    def load(self):
+        stamp = self.stamp()
+        if stamp is None:
+            return empty_snapshot(), 'empty'
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error("Ошибка при загрузке данных подарков: %s", e)
+            return None
+
+        if not isinstance(data, dict) or not isinstance(data.get('gifts'), list):
+            logger.error("Неверный формат файла подарков: %s", self.path)
+            return None
+
+        data.setdefault('lastUpdated', None)
+        return data, f"{stamp[0]:x}-{stamp[1]:x}"
+
+
+class GiftCatalog:
+    """
+    Каталог подарков в памяти процесса.
+
+    Данные читаются из источника (SQLite хранилище или JSON файл) один раз и
+    перечитываются только при изменении его отметки stamp(). Отметка
+    проверяется не чаще раза в check_interval секунд: изменения, записанные
+    этим процессом, видны сразу через replace(), а записи других процессов -
+    с задержкой не больше check_interval. Поиск по ID выполняется за O(1),
+    выборки по коллекции и статусу используют готовые индексы и не обращаются к диску.
+    """
+
+    def __init__(self, source, check_interval=0):
+        self.source = source
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._loaded = False
+        self._checked_at = 0.0
+        # Снимок и его индексы подменяются одной ссылкой
+        self._state = _CatalogState(empty_snapshot(), version='empty')
+
+    # Проверка актуальности каталога и перезагрузка при изменении источника
+    def _ensure_fresh(self):
+        if self._loaded and time.monotonic() - self._checked_at < self.check_interval:
+            return
+
+        stamp = self.source.stamp()
+        if self._loaded and stamp == self._stamp:
+            self._checked_at = time.monotonic()
+            return
+
+        with self._lock:
+            if self._loaded and stamp == self._stamp:
+                return
+
+            loaded = self.source.load()
+            if loaded is None:
+                # Оставляем предыдущий снимок, если источник поврежден
+                return
+
+            data, version = loaded
+            self._state = _CatalogState(data, version=version)
+            self._stamp = stamp
+            self._loaded = True
+            self._checked_at = time.monotonic()
+            logger.info("Каталог подарков загружен: %s подарков", len(data['gifts']))
+
+    # Замена снимка каталога данными, только что записанными в источник
+    def replace(self, gifts_data, version=None):
+        with self._lock:
+            self._state = _CatalogState(gifts_data, version=version)
+            self._stamp = self.source.stamp()
+            self._loaded = True
+            self._checked_at = time.monotonic()
+
+    # Версия текущего снимка (меняется при каждой замене данных)
+    @property
+    def version(self):
+        self._ensure_fresh()
+        return self._state.version
+
+    # Текущий снимок каталога
+    def snapshot(self):
+        self._ensure_fresh()
+        return self._state.data
+
+    # Получение подарка по ID
+    def get(self, gift_id):
+        self._ensure_fresh()
+        return self._state.by_id.get(str(gift_id))
+
+    # Выборка подарков по коллекции и статусу
+    def filter(self, collection=None, status='all'):
+        self._ensure_fresh()
+        state = self._state
+
+        if collection:
+            gifts = state.by_collection.get(collection, [])
+        else:
+            gifts = None
+
+        statuses = STATUS_GROUPS.get(status)
+        if statuses is None:
+            return list(gifts if gifts is not None else state.data['gifts'])
+
+        if gifts is not None:
+            return [gift for gift in gifts if gift.get('status') in statuses]
+
+        if len(statuses) == 1:
+            return list(state.by_status.get(statuses[0], []))
+
+        # Сохраняем исходный порядок подарков при объединении статусов
+        return [gift for gift in state.data['gifts'] if gift.get('status') in statuses]
+
+    # Выборка подарков с сортировкой по заранее отсортированному индексу
+    def query(self, collection=None, status='all', sort=None):
+        if not sort:
+            return self.filter(collection, status)
+
+        self._ensure_fresh()
+        ordered = self._state.sorted_by(sort, collection)
+        statuses = STATUS_GROUPS.get(status)
+
+        if statuses is None:
+            return ordered
+
+        return [gift for gift in ordered if gift.get('status') in statuses]
+
+    # Изменения каталога после версии since
+    def changes_since(self, since):
+        """
+        Возвращает версию и lastUpdated текущего снимка и подарки, добавленные
+        ("added"), измененные ("changed") и удаленные ("removed", только ID)
+        после версии since. Если версии since уже нет в журнале источника,
+        вместо изменений возвращается весь снимок ("full": True, "gifts").
+        """
+        self._ensure_fresh()
+        state = self._state
+        result = {"version": state.version, "lastUpdated": state.data.get('lastUpdated')}
+
+        if since == state.version:
+            entries = []
+        else:
+            changes_since = getattr(self.source, 'changes_since', None)
+            entries = changes_since(since, state.version) if since and changes_since else None
+
+        if entries is None:
+            result.update({"full": True, "gifts": state.data['gifts']})
+            return result
+
+        # Для каждого подарка важно только, был ли он в версии since и есть ли он сейчас
+        existed = {}
+        for entry in entries:
+            for gift_id in entry["added"]:
+                existed.setdefault(gift_id, False)
+            for gift_id in entry["changed"] + entry["removed"]:
+                existed.setdefault(gift_id, True)
+
+        added, changed, removed = [], [], []
+        for gift_id, was_present in existed.items():
+            gift = state.by_id.get(gift_id)
+            if gift is None:
+                if was_present:
+                    removed.append(gift_id)
+            elif was_present:
+                changed.append(gift)
+            else:
+                added.append(gift)
+
+        result.update({"full": False, "added": added, "changed": changed, "removed": removed})
+        return result
+
+    # Отсортированный список названий коллекций
+    def collections(self):
+        self._ensure_fresh()
+        return sorted(self._state.by_collection)
+
+    # Показатели коллекций текущего снимка (рассчитываются один раз при загрузке снимка)
+    def collection_stats(self):
+        self._ensure_fresh()
+        return self._state.collection_stats
+
+    def __len__(self):
+        self._ensure_fresh()
+        return len(self._state.data['gifts'])
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Рассылка изменений каталога подарков Fragment
+Изменения читаются из журнала каталога одной задачей asyncio на процесс и
+раздаются подписчикам потока Server-Sent Events без отдельного потока на клиента
+"""
+
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Формирование события Server-Sent Events
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}")
+    return ("\n".join(lines) + "\n\n").encode('utf-8')
+
+
+# Преобразование изменений каталога в записи (ID, был ли подарок раньше, подарок, коллекции)
+def change_items(changes, known_collections):
+    items = []
+    for gift in changes["added"]:
+        gift_id = str(gift.get('id'))
+        items.append((gift_id, False, gift, {gift.get('collection')}))
+    for gift in changes["changed"]:
+        gift_id = str(gift.get('id'))
+        # Подписчики прежней коллекции тоже должны узнать, что подарок из нее ушел
+        items.append((gift_id, True, gift, {gift.get('collection'), known_collections.get(gift_id)}))
+    for gift_id in changes["removed"]:
+        items.append((gift_id, True, None, {known_collections.get(gift_id)}))
+    return items
+
+
+class Subscription:
+    """
+    Подписка одного клиента.
+
+    Изменения накапливаются до отправки: несколько изменений одного подарка
+    сливаются в одно, поэтому при всплеске обновлений медленный клиент
+    получает одно событие с последним состоянием. Если накопилось больше
+    max_pending подарков, клиенту отправляется событие reset.
+    """
+
+    def __init__(self, collections=None, max_pending=1000):
+        self.collections = set(collections) if collections else None
+        self.max_pending = max_pending
+        self.version = None
+        self.reset = False
+        self.closed = False
+        self._pending = {}
+        self._wake = asyncio.Event()
+
+    # Добавление изменений (записи из change_items)
+    def push(self, version, items):
+        if self.collections is not None:
+            items = [item for item in items if item[3] & self.collections]
+        if not items:
+            return
+
+        for gift_id, was_present, gift, _ in items:
+            previous = self._pending.get(gift_id)
+            self._pending[gift_id] = (previous[0] if previous else was_present, gift)
+        self.version = version
+
+        if len(self._pending) > self.max_pending:
+            # Клиент не успевает получать изменения, пусть перезагрузит каталог
+            self.push_reset(version)
+            return
+        self._wake.set()
+
+    # Запрос полной перезагрузки каталога на клиенте
+    def push_reset(self, version):
+        self._pending = {}
+        self.reset = True
+        self.version = version
+        self._wake.set()
+
+    def close(self):
+        self.closed = True
+        self._wake.set()
+
+    # Ожидание изменений; False, если за timeout ничего не произошло
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    # Накопленные изменения в виде события (имя, данные) или None
+    def drain(self):
+        self._wake.clear()
+
+        if self.reset:
+            self.reset = False
+            return 'reset', {"version": self.version}
+
+        added, changed, removed = [], [], []
+        for gift_id, (was_present, gift) in self._pending.items():
+            if gift is None:
+                if was_present:
+                    removed.append(gift_id)
+            elif was_present:
+                changed.append(gift)
+            else:
+                added.append(gift)
+        self._pending = {}
+
+        if not (added or changed or removed):
+            return None
+        return 'change', {"version": self.version, "added": added, "changed": changed, "removed": removed}
+
+
+class ChangeBroadcaster:
+    """
+    Источник событий для потока изменений.
+
+    Раз в poll_interval секунд проверяет версию каталога (в пуле потоков через
+    run_blocking) и при ее смене раздает изменения из журнала всем подпискам.
+    Работает в каждом процессе сервера и видит обновления, записанные любым из них.
+    """
+
+    def __init__(self, catalog, run_blocking, poll_interval=1.0, max_subscribers=5000, max_pending=1000):
+        self.catalog = catalog
+        self.run_blocking = run_blocking
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.version = None
+        self._subscribers = set()
+        self._collections = {}
+        self._task = None
+        self._ready = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        for subscription in list(self._subscribers):
+            subscription.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # Ожидание загрузки начальной версии каталога
+    async def wait_ready(self):
+        self.start()
+        await self._ready.wait()
+
+    def subscribe(self, collections=None):
+        if len(self._subscribers) >= self.max_subscribers:
+            return None
+        subscription = Subscription(collections, self.max_pending)
+        subscription.version = self.version
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    # Досылка подписке изменений, пропущенных после версии since (переподключение)
+    async def replay(self, subscription, since):
+        changes = await self.run_blocking(self.catalog.changes_since, since)
+        if changes["full"]:
+            subscription.push_reset(changes["version"])
+        else:
+            subscription.push(changes["version"], change_items(changes, self._collections))
+
+    def _remember(self, gifts):
+        self._collections = {str(gift.get('id')): gift.get('collection') for gift in gifts}
+
+    async def _poll(self):
+        if self.version is None:
+            changes = await self.run_blocking(self.catalog.changes_since, None)
+            self._remember(changes["gifts"])
+            self.version = changes["version"]
+            self._ready.set()
+            return
+
+        changes = await self.run_blocking(self.catalog.changes_since, self.version)
+        if changes["version"] == self.version:
+            return
+
+        if changes["full"]:
+            for subscription in self._subscribers:
+                subscription.push_reset(changes["version"])
+            self._remember(changes["gifts"])
+        else:
+            items = change_items(changes, self._collections)
+            for subscription in self._subscribers:
+                subscription.push(changes["version"], items)
+
+            for gift_id, _, gift, _ in items:
+                if gift is None:
+                    self._collections.pop(gift_id, None)
+                else:
+                    self._collections[gift_id] = gift.get('collection')
+
+        logger.info("Изменения каталога %s разосланы %s подписчикам", changes['version'], len(self._subscribers))
+        self.version = changes["version"]
+
+    async def _run(self):
+        while True:
+            try:
+                await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при проверке изменений каталога: %s", e)
+            await asyncio.sleep(self.poll_interval)
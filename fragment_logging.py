@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Логирование бэкенда Fragment
+Записи передаются через очередь в отдельный поток (QueueHandler/QueueListener),
+форматируются там же в JSON с ID запроса и пишутся в файл с ротацией по размеру
+"""
+
+import copy
+import json
+import queue
+import uuid
+import atexit
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# ID текущего запроса и признак того, что INFO записи запроса попадают в лог
+request_id_var = contextvars.ContextVar('request_id', default=None)
+log_sampled_var = contextvars.ContextVar('log_sampled', default=True)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+# Привязка ID запроса к текущему контексту; возвращает токены для unbind_request
+def bind_request(request_id, sampled=True):
+    return request_id_var.set(request_id), log_sampled_var.set(sampled)
+
+
+def unbind_request(tokens):
+    request_id, sampled = tokens
+    request_id_var.reset(request_id)
+    log_sampled_var.reset(sampled)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Добавляет к записи ID запроса и отбрасывает записи ниже WARNING для
+    запросов, не попавших в выборку. Выполняется в потоке запроса.
+    """
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and not log_sampled_var.get():
+            return False
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога в виде одной строки JSON."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry["requestId"] = request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler, который не форматирует сообщение в потоке запроса.
+
+    Стандартный prepare() подставляет аргументы в сообщение до постановки в
+    очередь; здесь запись передается как есть, и getMessage() вызывается уже
+    в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+
+class LogSampler:
+    """Выборка запросов к частым маршрутам, INFO записи которых попадают в лог."""
+
+    def __init__(self, rate=1.0, routes=()):
+        self.rate = rate
+        self.routes = frozenset(routes)
+
+    def sampled(self, route):
+        return route not in self.routes or self.rate >= 1 or random.random() < self.rate
+
+
+# Настройка логирования процесса; возвращает запущенный QueueListener
+def configure_logging(path, max_bytes=10 * 1024 * 1024, backups=5, json_format=True, level=logging.INFO):
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+
+    # Файл открывается при первой записи, а не при импорте
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при завершении процесса
+    atexit.register(listener.stop)
+    return listener
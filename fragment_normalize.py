@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Пакетная нормализация подарков Fragment
+Преобразует список подарков из ton_fragment в колоночное представление
+и формирует из него словари/JSON в формате gift_to_dict. JSON строки подарков
+передаются дальше в хранилище каталога и JSON экспорт, чтобы не сериализовать
+каталог повторно
+"""
+
+import sys
+import json
+from array import array
+
+_MISSING = float('nan')
+
+# Кодирование строки в JSON литерал (как json.dumps с ensure_ascii=False)
+_encode_string = json.encoder.encode_basestring
+
+
+# Интернирование повторяющихся строковых значений
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+# Кодирование произвольного значения в JSON литерал
+def _encode(value):
+    if type(value) is str:
+        return _encode_string(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+# Преобразование объекта Gift в словарь для JSON (по одному подарку)
+def gift_to_dict(gift):
+    return {
+        "id": str(gift.get('id', '0')),
+        "name": gift.get('name', 'Unknown'),
+        "owner": gift.get('owner', 'unknown'),
+        "collection": gift.get('collection', 'Unknown'),
+        "status": gift.get('status', 'not_for_sale'),
+        "price": {
+            "amount": str(gift.get('price', 0)),
+            "currency": "TON"
+        },
+        "model": {
+            "name": gift.get('model', {}).get('name', 'Unknown'),
+            "rarity": f"{gift.get('model', {}).get('rarity', 0):.1f}%"
+        },
+        "background": {
+            "name": gift.get('background', {}).get('name', 'Unknown'),
+            "rarity": f"{gift.get('background', {}).get('rarity', 0):.1f}%"
+        },
+        "symbol": {
+            "name": gift.get('symbol', {}).get('name', 'Unknown'),
+            "rarity": f"{gift.get('symbol', {}).get('rarity', 0):.1f}%"
+        },
+        "supply": gift.get('supply', 'Unknown'),
+        "image": gift.get('image', f"https://via.placeholder.com/300x300?text={gift.get('name', 'Unknown')}"),
+        "animatedImage": gift.get('animated_image'),
+        "url": gift.get('url', f"https://fragment.com/gift/{gift.get('id', '0')}")
+    }
+
+
+# Числовое значение для колонок цены и редкости
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return _MISSING
+
+
+class GiftColumns:
+    """
+    Колоночное представление списка подарков.
+
+    Цены и редкости хранятся в массивах array('d'), повторяющиеся строки
+    (коллекция, статус, названия модели/фона/символа) интернируются, а
+    форматирование редкостей ("1.5%") выполняется один раз на уникальное значение.
+    """
+
+    # Названия вложенных атрибутов подарка
+    ATTRIBUTES = ('model', 'background', 'symbol')
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.owners = []
+        self.collections = []
+        self.statuses = []
+        self.price_amounts = []
+        self.prices = array('d')
+        self.attribute_names = {attr: [] for attr in self.ATTRIBUTES}
+        self.attribute_rarities = {attr: array('d') for attr in self.ATTRIBUTES}
+        self.supplies = []
+        self.images = []
+        self.animated_images = []
+        self.urls = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Построение колонок из списка подарков ton_fragment
+    @classmethod
+    def from_upstream(cls, gifts):
+        columns = cls()
+        intern = _intern
+        empty = {}
+
+        ids = columns.ids
+        names = columns.names
+        owners = columns.owners
+        collections = columns.collections
+        statuses = columns.statuses
+        price_amounts = columns.price_amounts
+        prices = columns.prices
+        attribute_columns = [(attr, columns.attribute_names[attr], columns.attribute_rarities[attr])
+                             for attr in cls.ATTRIBUTES]
+        supplies = columns.supplies
+        images = columns.images
+        animated_images = columns.animated_images
+        urls = columns.urls
+
+        for gift in gifts:
+            get = gift.get
+            gift_id = str(get('id', '0'))
+            name = get('name', 'Unknown')
+            price = get('price', 0)
+
+            ids.append(gift_id)
+            names.append(name)
+            owners.append(get('owner', 'unknown'))
+            collections.append(intern(get('collection', 'Unknown')))
+            statuses.append(intern(get('status', 'not_for_sale')))
+            price_amounts.append(str(price))
+            prices.append(_to_float(price))
+
+            for attr, attr_names, attr_rarities in attribute_columns:
+                value = get(attr, empty)
+                attr_names.append(intern(value.get('name', 'Unknown')))
+                attr_rarities.append(_to_float(value.get('rarity', 0)))
+
+            supplies.append(get('supply', 'Unknown'))
+            images.append(get('image') if 'image' in gift else f"https://via.placeholder.com/300x300?text={name}")
+            animated_images.append(get('animated_image'))
+            urls.append(get('url') if 'url' in gift else f"https://fragment.com/gift/{get('id', '0')}")
+
+        return columns
+
+    # Отформатированные редкости ("1.5%") для одного атрибута
+    def _formatted_rarities(self, attr, cache):
+        formatted = []
+        append = formatted.append
+        for value in self.attribute_rarities[attr]:
+            text = cache.get(value)
+            if text is None:
+                text = f"{value:.1f}%"
+                cache[value] = text
+            append(text)
+        return formatted
+
+    # Преобразование колонок в список словарей (формат gift_to_dict)
+    def to_dicts(self):
+        cache = {}
+        model_rarities = self._formatted_rarities('model', cache)
+        background_rarities = self._formatted_rarities('background', cache)
+        symbol_rarities = self._formatted_rarities('symbol', cache)
+
+        return [
+            {
+                "id": gift_id,
+                "name": name,
+                "owner": owner,
+                "collection": collection,
+                "status": status,
+                "price": {"amount": amount, "currency": "TON"},
+                "model": {"name": model_name, "rarity": model_rarity},
+                "background": {"name": background_name, "rarity": background_rarity},
+                "symbol": {"name": symbol_name, "rarity": symbol_rarity},
+                "supply": supply,
+                "image": image,
+                "animatedImage": animated_image,
+                "url": url
+            }
+            for (gift_id, name, owner, collection, status, amount,
+                 model_name, model_rarity, background_name, background_rarity,
+                 symbol_name, symbol_rarity, supply, image, animated_image, url)
+            in zip(self.ids, self.names, self.owners, self.collections, self.statuses, self.price_amounts,
+                   self.attribute_names['model'], model_rarities,
+                   self.attribute_names['background'], background_rarities,
+                   self.attribute_names['symbol'], symbol_rarities,
+                   self.supplies, self.images, self.animated_images, self.urls)
+        ]
+
+    # JSON представление каждого подарка (компактное, как json.dumps с separators=(',', ':'))
+    def to_json_rows(self):
+        cache = {}
+        encoded = {}
+
+        # Повторяющиеся строки кодируются в JSON один раз
+        def encode_column(values):
+            result = []
+            append = result.append
+            for value in values:
+                text = encoded.get(value)
+                if text is None:
+                    text = _encode(value)
+                    encoded[value] = text
+                append(text)
+            return result
+
+        rows = zip(
+            map(_encode_string, self.ids),
+            map(_encode, self.names),
+            map(_encode, self.owners),
+            encode_column(self.collections),
+            encode_column(self.statuses),
+            map(_encode_string, self.price_amounts),
+            encode_column(self.attribute_names['model']),
+            encode_column(self._formatted_rarities('model', cache)),
+            encode_column(self.attribute_names['background']),
+            encode_column(self._formatted_rarities('background', cache)),
+            encode_column(self.attribute_names['symbol']),
+            encode_column(self._formatted_rarities('symbol', cache)),
+            map(_encode, self.supplies),
+            map(_encode, self.images),
+            map(_encode, self.animated_images),
+            map(_encode, self.urls),
+        )
+
+        template = ('{{"id":{},"name":{},"owner":{},"collection":{},"status":{},'
+                    '"price":{{"amount":{},"currency":"TON"}},'
+                    '"model":{{"name":{},"rarity":{}}},'
+                    '"background":{{"name":{},"rarity":{}}},'
+                    '"symbol":{{"name":{},"rarity":{}}},'
+                    '"supply":{},"image":{},"animatedImage":{},"url":{}}}').format
+
+        return [template(*row) for row in rows]
+
+    # Формирование JSON массива подарков напрямую из колонок
+    def to_json(self):
+        return '[' + ','.join(self.to_json_rows()) + ']'
+
+
+class NormalizedGifts(list):
+    """Список подарков в формате API вместе с JSON строкой каждого подарка (json_rows)."""
+
+    def __init__(self, gifts, json_rows):
+        super().__init__(gifts)
+        self.json_rows = json_rows
+
+
+# JSON строки подарков: готовые из NormalizedGifts или сериализованные по одной
+def json_rows(gifts):
+    rows = getattr(gifts, 'json_rows', None)
+    if rows is None:
+        rows = [json.dumps(gift, ensure_ascii=False, separators=(',', ':')) for gift in gifts]
+    return rows
+
+
+# Нормализация списка подарков ton_fragment в словари формата API
+def normalize_gifts(gifts):
+    return GiftColumns.from_upstream(gifts).to_dicts()
+
+
+# Нормализация каталога: словари для снимка в памяти и JSON строки для хранилища и экспорта
+def normalize_catalog(gifts):
+    columns = GiftColumns.from_upstream(gifts)
+    return NormalizedGifts(columns.to_dicts(), columns.to_json_rows())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Очередь покупок подарков Fragment
+Идемпотентные покупки с журналом в SQLite, исключительным доступом к подарку через журнал
+и ограниченным пулом исполнителей
+"""
+
+import os
+import uuid
+import sqlite3
+import contextvars
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Состояния покупки
+QUEUED = 'queued'
+PROCESSING = 'processing'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+INTERRUPTED = 'interrupted'
+
+
+class IdempotencyConflictError(Exception):
+    """Ключ идемпотентности уже использован для другой покупки."""
+
+
+class QueueFullError(Exception):
+    """В очереди покупок нет свободных мест."""
+
+
+# Время запуска процесса из /proc (Linux); None, если его не узнать
+def _process_start_time(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Поле starttime идет 20-м после имени процесса в скобках
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+_process_tokens = {}
+
+
+# Признак запуска текущего процесса: PID может достаться перезапущенному серверу,
+# а время запуска (или случайный токен) у каждого запуска свое
+def _process_token():
+    pid = os.getpid()
+    if pid not in _process_tokens:
+        _process_tokens[pid] = _process_start_time(pid) or uuid.uuid4().hex
+    return _process_tokens[pid]
+
+
+# Проверка, что запуск процесса, записанный в журнал, еще работает
+def _process_alive(pid, token):
+    if pid == os.getpid():
+        # Тот же PID, но другой токен: запись осталась от прежнего запуска
+        return token == _process_token()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    # PID мог достаться другому процессу; без /proc считаем процесс работающим
+    start_time = _process_start_time(pid)
+    return start_time is None or start_time == token
+
+
+class PurchaseJournal:
+    """Журнал покупок в SQLite (режим WAL)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS purchases (
+                job_id TEXT PRIMARY KEY,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                gift_id TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                status TEXT NOT NULL,
+                transaction_id TEXT,
+                error TEXT,
+                owner_pid INTEGER NOT NULL,
+                owner_token TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        """)
+        # Журналы, созданные до появления owner_token, получают столбец (NULL: владелец неизвестен)
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(purchases)")]
+        if "owner_token" not in columns:
+            self._conn.execute("ALTER TABLE purchases ADD COLUMN owner_token TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS purchases_status ON purchases (status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS purchases_gift_status ON purchases (gift_id, status)")
+
+    # Преобразование строки таблицы в словарь для API
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        return {
+            "jobId": row["job_id"],
+            "giftId": row["gift_id"],
+            "recipient": row["recipient"],
+            "status": row["status"],
+            "transactionId": row["transaction_id"],
+            "error": row["error"],
+            "createdAt": row["created_at"],
+            "updatedAt": row["updated_at"]
+        }
+
+    # Создание покупки; если ключ уже есть, возвращается существующая запись
+    def create(self, idempotency_key, gift_id, recipient):
+        now = datetime.now().isoformat()
+        job_id = uuid.uuid4().hex
+
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT INTO purchases (job_id, idempotency_key, gift_id, recipient, status, owner_pid, "
+                    "owner_token, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, idempotency_key, gift_id, recipient, QUEUED, os.getpid(), _process_token(), now, now)
+                )
+                created = True
+            except sqlite3.IntegrityError:
+                # Ключ уже использован (в том числе другим процессом)
+                created = False
+
+            row = self._conn.execute(
+                "SELECT * FROM purchases WHERE idempotency_key = ?", (idempotency_key,)
+            ).fetchone()
+            return self._to_dict(row), created
+
+    # Перевод покупки в обработку, если этот подарок сейчас не покупается ни одним процессом
+    def start(self, job_id, gift_id):
+        with self._lock:
+            # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому проверка и обновление
+            # выполняются атомарно для всех процессов, работающих с журналом
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(
+                    "UPDATE purchases SET status = ?, owner_pid = ?, owner_token = ?, updated_at = ? "
+                    "WHERE job_id = ? AND status = ? "
+                    "AND NOT EXISTS (SELECT 1 FROM purchases WHERE gift_id = ? AND status = ?)",
+                    (PROCESSING, os.getpid(), _process_token(), datetime.now().isoformat(), job_id, QUEUED,
+                     gift_id, PROCESSING)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    # Обновление состояния покупки
+    def update(self, job_id, status, transaction_id=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE purchases SET status = ?, transaction_id = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                (status, transaction_id, error, datetime.now().isoformat(), job_id)
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM purchases WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    # Количество покупок в каждом состоянии
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM purchases GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    # Незавершенные покупки, принадлежащие запускам процессов, которые уже не работают
+    def find_orphaned(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM purchases WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, PROCESSING)
+            ).fetchall()
+        return [
+            (self._to_dict(row), (row["owner_pid"], row["owner_token"]))
+            for row in rows if not _process_alive(row["owner_pid"], row["owner_token"])
+        ]
+
+    # Атомарный перехват покупки у завершившегося процесса (previous_owner: PID и токен запуска)
+    def claim(self, job_id, previous_owner):
+        owner_pid, owner_token = previous_owner
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE purchases SET owner_pid = ?, owner_token = ? "
+                "WHERE job_id = ? AND owner_pid = ? AND owner_token IS ?",
+                (os.getpid(), _process_token(), job_id, owner_pid, owner_token)
+            )
+        return cursor.rowcount == 1
+
+
+class PurchaseQueue:
+    """
+    Очередь покупок.
+
+    Покупки выполняются пулом из workers потоков. Одновременно покупается не
+    больше одного экземпляра каждого подарка: исключительность проверяется в
+    журнале и действует для всех процессов сервера. Покупка, подарок которой
+    уже покупается, не занимает исполнителя, а возвращается в очередь через
+    retry_delay секунд. Повторный запрос с тем же ключом идемпотентности
+    возвращает уже созданную покупку и не покупает подарок снова.
+    """
+
+    def __init__(self, journal, buy, workers=4, max_pending=100, retry_delay=0.5):
+        self.journal = journal
+        self.buy = buy
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="purchase")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = False
+
+    # Восстановление очереди после перезапуска (вызывается при запуске сервера)
+    def recover(self):
+        for job, owner in self.journal.find_orphaned():
+            if not self.journal.claim(job["jobId"], owner):
+                continue
+
+            if job["status"] == PROCESSING:
+                # Результат прерванной покупки неизвестен, повторять ее небезопасно
+                self.journal.update(job["jobId"], INTERRUPTED, error="Purchase interrupted by backend restart")
+                logger.error("Покупка %s подарка %s была прервана перезапуском", job['jobId'], job['giftId'])
+            else:
+                with self._lock:
+                    self._pending += 1
+                self._schedule(job)
+
+    # Передача покупки исполнителю (место в очереди уже занято)
+    def _schedule(self, job, context=None):
+        if self._closed:
+            return
+        # Контекст запроса (ID для логов) переходит в поток исполнителя
+        context = (context or contextvars.copy_context()).copy()
+        self._executor.submit(context.run, self._process, job, context)
+
+    # Повторная попытка после того, как подарок освободится
+    def _retry_later(self, job, context):
+        timer = threading.Timer(self.retry_delay, self._schedule, (job, context))
+        timer.daemon = True
+        timer.start()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    # Выполнение покупки в потоке пула
+    def _process(self, job, context):
+        job_id, gift_id, recipient = job["jobId"], job["giftId"], job["recipient"]
+        try:
+            if not self.journal.start(job_id, gift_id):
+                current = self.journal.get(job_id)
+                if current and current["status"] == QUEUED:
+                    # Подарок покупается другой задачей (возможно, в другом процессе)
+                    self._retry_later(job, context)
+                    return
+                # Покупку уже обработал другой процесс
+                self._release()
+                return
+        except Exception as e:
+            logger.error("Ошибка при постановке покупки %s в обработку: %s", job_id, e)
+            self._retry_later(job, context)
+            return
+
+        try:
+            logger.info("Покупка подарка с ID: %s для получателя: %s (задача %s)", gift_id, recipient, job_id)
+
+            try:
+                result = self.buy(gift_id, recipient)
+            except Exception as e:
+                logger.error("Ошибка при покупке подарка через API: %s", e)
+                self.journal.update(job_id, FAILED, error=str(e))
+                return
+
+            if result and result.get('success'):
+                self.journal.update(job_id, SUCCEEDED, transaction_id=result.get('transaction_id', 'unknown'))
+                logger.info("Подарок %s куплен для %s (задача %s)", gift_id, recipient, job_id)
+            else:
+                error = (result or {}).get('error', 'Unknown error')
+                self.journal.update(job_id, FAILED, error=error)
+                logger.error("Покупка подарка %s не выполнена: %s", gift_id, error)
+        finally:
+            self._release()
+
+    # Постановка покупки в очередь; возвращает (покупка, создана ли новая)
+    def submit(self, gift_id, recipient, idempotency_key=None):
+        idempotency_key = idempotency_key or uuid.uuid4().hex
+
+        # Место в очереди занимается до записи в журнал, чтобы проверка лимита была атомарной
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError("Purchase queue is full")
+            self._pending += 1
+
+        try:
+            job, created = self.journal.create(idempotency_key, gift_id, recipient)
+        except BaseException:
+            self._release()
+            raise
+
+        if not created:
+            self._release()
+            if job["giftId"] != gift_id or job["recipient"] != recipient:
+                raise IdempotencyConflictError("Idempotency key was already used for another purchase")
+            return job, False
+
+        self._schedule(job)
+        return job, True
+
+    def get(self, job_id):
+        return self.journal.get(job_id)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Фоновое обновление каталога подарков
+Периодически загружает каталог из Fragment API и публикует новый снимок
+"""
+
+import random
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogRefresher:
+    """
+    Фоновый поток, который загружает каталог с интервалом interval секунд.
+
+    fetch() возвращает список подарков, publish(gifts_data) атомарно подменяет
+    снимок каталога. При ошибках API интервал заменяется экспоненциальной
+    задержкой со случайным разбросом (не больше max_backoff).
+    """
+
+    def __init__(self, fetch, publish, interval=60, min_backoff=5, max_backoff=600):
+        self.fetch = fetch
+        self.publish = publish
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._completed = threading.Condition(self._lock)
+        self._thread = None
+
+        # Состояние последнего обновления
+        self._started = 0
+        self.generation = 0
+        self.failures = 0
+        self.last_result = None
+        self.last_success = None
+
+    # Запуск фонового потока (повторный вызов ничего не делает)
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="catalog-refresher", daemon=True)
+            self._thread.start()
+            logger.info("Фоновое обновление каталога запущено (интервал: %s с)", self.interval)
+
+    # Остановка фонового потока
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Задержка перед следующей попыткой после ошибки
+    def _backoff_delay(self):
+        delay = min(self.max_backoff, self.min_backoff * (2 ** (self.failures - 1)))
+        return random.uniform(delay / 2, delay)
+
+    # Одна итерация обновления каталога
+    def _refresh_once(self):
+        with self._lock:
+            self._started += 1
+
+        try:
+            gifts = self.fetch()
+            gifts_data = {
+                "gifts": gifts,
+                "lastUpdated": datetime.now().isoformat()
+            }
+            self.publish(gifts_data)
+            result = {"success": True, "count": len(gifts), "lastUpdated": gifts_data["lastUpdated"]}
+            logger.info("Каталог обновлен: %s подарков", len(gifts))
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+            logger.error("Ошибка при фоновом обновлении каталога: %s", e)
+
+        with self._completed:
+            self.failures = 0 if result["success"] else self.failures + 1
+            self.generation += 1
+            self.last_result = result
+            if result["success"]:
+                self.last_success = result["lastUpdated"]
+            self._completed.notify_all()
+
+        return result
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            self._refresh_once()
+            delay = self.interval if self.failures == 0 else self._backoff_delay()
+            self._wake.wait(delay)
+
+    # Внеочередное обновление; при wait=True ждем его завершения
+    def trigger(self, wait=False, timeout=None):
+        self.start()
+
+        with self._completed:
+            # Ждем обновление, которое начнется после этого запроса
+            target = self._started + 1
+            self._wake.set()
+
+            if not wait:
+                return None
+
+            if not self._completed.wait_for(lambda: self.generation >= target, timeout):
+                return None
+            return self.last_result
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Хранилище каталога подарков Fragment
+Каталог в SQLite (режим WAL) с инкрементальным обновлением: при каждом
+обновлении записываются только добавленные, измененные и удаленные подарки,
+а изменения последних версий сохраняются в журнале для выдачи дельт клиентам
+"""
+
+import json
+import hashlib
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+from fragment_catalog import price_value
+from fragment_normalize import json_rows
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogStore:
+    """
+    Каталог подарков в SQLite.
+
+    Используется как источник данных для GiftCatalog: stamp() меняется после
+    записи из любого соединения или процесса, load() возвращает снимок каталога.
+    upsert() сравнивает новый список подарков с сохраненным по хэшам и пишет
+    только изменившиеся строки. Порядок подарков хранится одним списком ID в
+    meta, поэтому новый подарок в начале списка не переписывает остальные строки.
+    Журнал changes хранит ID измененных подарков для последних history версий
+    (старые записи вытесняются).
+    """
+
+    def __init__(self, path, history=100):
+        self.path = path
+        self.history = history
+
+        # Отдельные соединения для чтения и записи (WAL позволяет читать во время записи)
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._writer = self._connect()
+        self._reader = self._connect()
+
+        with self._write_lock:
+            self._writer.executescript("""
+                CREATE TABLE IF NOT EXISTS gifts (
+                    id TEXT PRIMARY KEY,
+                    collection TEXT,
+                    status TEXT,
+                    price REAL,
+                    hash TEXT NOT NULL,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS gifts_collection ON gifts (collection);
+                CREATE INDEX IF NOT EXISTS gifts_status ON gifts (status);
+                CREATE INDEX IF NOT EXISTS gifts_price ON gifts (price);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    version TEXT NOT NULL,
+                    previous_version TEXT NOT NULL,
+                    added TEXT NOT NULL,
+                    changed TEXT NOT NULL,
+                    removed TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS changes_version ON changes (version);
+            """)
+            self._migrate_positions()
+
+    # Перенос порядка из столбца position (прежний формат хранилища) в meta
+    def _migrate_positions(self):
+        conn = self._writer
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(gifts)")]
+            if 'position' in columns:
+                order = [row[0] for row in conn.execute("SELECT id FROM gifts ORDER BY position")]
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('order', ?)",
+                             (json.dumps(order, separators=(',', ':')),))
+                conn.execute("ALTER TABLE gifts DROP COLUMN position")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Отметка изменения данных (меняется после записи другим соединением)
+    def stamp(self):
+        with self._read_lock:
+            return self._reader.execute("PRAGMA data_version").fetchone()[0]
+
+    # Загрузка снимка каталога; возвращает (данные, версия)
+    def load(self):
+        with self._read_lock:
+            self._reader.execute("BEGIN")
+            try:
+                meta = dict(self._reader.execute("SELECT key, value FROM meta").fetchall())
+                # Подарки в порядке списка ID из meta
+                row = self._reader.execute(
+                    "SELECT group_concat(data, ',') FROM ("
+                    "SELECT gifts.data FROM json_each((SELECT value FROM meta WHERE key = 'order')) AS item "
+                    "JOIN gifts ON gifts.id = item.value ORDER BY item.key)"
+                ).fetchone()
+            finally:
+                self._reader.execute("COMMIT")
+
+        data = {"gifts": json.loads(f"[{row[0] or ''}]"), "lastUpdated": meta.get('lastUpdated')}
+        if meta.get('isTestData') == '1':
+            data["isTestData"] = True
+        return data, meta.get('version') or 'empty'
+
+    def __len__(self):
+        with self._read_lock:
+            return self._reader.execute("SELECT COUNT(*) FROM gifts").fetchone()[0]
+
+    # Получение подарка по ID
+    def get(self, gift_id):
+        with self._read_lock:
+            row = self._reader.execute("SELECT data FROM gifts WHERE id = ?", (str(gift_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Записи журнала изменений после версии since до версии until включительно
+    def changes_since(self, since, until):
+        """
+        Возвращает список словарей {"added", "changed", "removed"} в порядке
+        обновлений или None, если одной из версий уже нет в журнале.
+        """
+        with self._read_lock:
+            self._reader.execute("BEGIN")
+            try:
+                since_seq = self._reader.execute(
+                    "SELECT MAX(seq) FROM changes WHERE version = ?", (since,)
+                ).fetchone()[0]
+                if since_seq is None:
+                    # Версия, с которой начинается самая старая запись журнала
+                    first_seq = self._reader.execute(
+                        "SELECT MIN(seq) FROM changes WHERE previous_version = ?", (since,)
+                    ).fetchone()[0]
+                    since_seq = first_seq - 1 if first_seq is not None else None
+
+                until_seq = self._reader.execute(
+                    "SELECT MAX(seq) FROM changes WHERE version = ?", (until,)
+                ).fetchone()[0]
+
+                if since_seq is None or until_seq is None or since_seq > until_seq:
+                    return None
+
+                rows = self._reader.execute(
+                    "SELECT added, changed, removed FROM changes WHERE seq > ? AND seq <= ? ORDER BY seq",
+                    (since_seq, until_seq)
+                ).fetchall()
+            finally:
+                self._reader.execute("COMMIT")
+
+        return [
+            {"added": json.loads(added), "changed": json.loads(changed), "removed": json.loads(removed)}
+            for added, changed, removed in rows
+        ]
+
+    # Инкрементальное обновление каталога
+    def upsert(self, gifts, last_updated, test_data=False):
+        """
+        Возвращает словарь с ID добавленных ("added"), измененных ("changed")
+        и удаленных ("removed") подарков, новой версией каталога ("version")
+        и признаком "unchanged", если записывать ничего не пришлось.
+        test_data отмечает тестовый каталог, созданный без Fragment API.
+        """
+        rows = []
+        seen = set()
+        catalog_hash = hashlib.sha256()
+
+        # JSON строки берутся из нормализации, если каталог пришел из normalize_catalog
+        for gift, data in zip(gifts, json_rows(gifts)):
+            gift_id = str(gift.get('id'))
+            if gift_id in seen:
+                continue
+            seen.add(gift_id)
+
+            gift_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+            catalog_hash.update(f"{gift_id}:{gift_hash};".encode('utf-8'))
+            rows.append((gift_id, gift.get('collection'), gift.get('status'), price_value(gift), gift_hash, data))
+
+        version = catalog_hash.hexdigest()[:16]
+        order = json.dumps([row[0] for row in rows], separators=(',', ':'))
+
+        with self._write_lock:
+            conn = self._writer
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                previous = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+                stored_order = conn.execute("SELECT value FROM meta WHERE key = 'order'").fetchone()
+                existing = dict(conn.execute("SELECT id, hash FROM gifts"))
+
+                added = [row for row in rows if row[0] not in existing]
+                changed = [row for row in rows if row[0] in existing and existing[row[0]] != row[4]]
+                removed = [gift_id for gift_id in existing if gift_id not in seen]
+                reordered = (stored_order[0] if stored_order else None) != order
+
+                if not (added or changed or removed or reordered):
+                    conn.execute("ROLLBACK")
+                    return {"added": [], "changed": [], "removed": [], "version": version, "unchanged": True}
+
+                if removed:
+                    conn.executemany("DELETE FROM gifts WHERE id = ?", [(gift_id,) for gift_id in removed])
+                if added or changed:
+                    conn.executemany(
+                        "INSERT INTO gifts (id, collection, status, price, hash, data) "
+                        "VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET "
+                        "collection = excluded.collection, status = excluded.status, price = excluded.price, "
+                        "hash = excluded.hash, data = excluded.data",
+                        added + changed
+                    )
+
+                meta = [('version', version), ('lastUpdated', last_updated), ('isTestData', '1' if test_data else '0')]
+                if reordered:
+                    meta.append(('order', order))
+                conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta)
+
+                # Журнал изменений: сохраняем последние history версий
+                conn.execute(
+                    "INSERT INTO changes (version, previous_version, added, changed, removed, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (version, previous[0] if previous else 'empty',
+                     json.dumps([row[0] for row in added]), json.dumps([row[0] for row in changed]),
+                     json.dumps(removed), datetime.now().isoformat())
+                )
+                conn.execute(
+                    "DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (self.history,)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        logger.info("Каталог в SQLite обновлен: +%s ~%s -%s", len(added), len(changed), len(removed))
+        return {
+            "added": [row[0] for row in added],
+            "changed": [row[0] for row in changed],
+            "removed": removed,
+            "version": version,
+            "unchanged": False
+        }
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Клиент Fragment API
+Обертка над ton_fragment.Client с пулом соединений, таймаутами, повторами
+с экспоненциальной задержкой, автоматическим выключателем и метриками вызовов
+"""
+
+import time
+import queue
+import random
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Fragment API временно недоступен, вызов отклонен без обращения к API."""
+
+
+class DeadlineExceededError(Exception):
+    """Время, отведенное на вызов Fragment API, истекло."""
+
+
+# Таймаут HTTP запросов текущего потока, ограниченный сроком вызова (см. UpstreamClient.call)
+_request_timeout = threading.local()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP адаптер с таймаутом по умолчанию и пулом keep-alive соединений."""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = getattr(_request_timeout, 'value', None) or self.timeout
+        return super().send(request, **kwargs)
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель.
+
+    После failure_threshold ошибок подряд вызовы отклоняются в течение
+    reset_timeout секунд, затем пропускается один пробный вызов.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+
+    # Проверка, можно ли выполнить вызов
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_in_progress:
+                return False
+            self._trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_progress or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._trial_in_progress:
+                    logger.error("Fragment API недоступен, выключатель разомкнут на %s с", self.reset_timeout)
+                self.opened_at = time.monotonic()
+            self._trial_in_progress = False
+
+
+class UpstreamClient:
+    """
+    Клиент для вызовов функций ton_fragment.
+
+    - Экземпляры ton_fragment.Client берутся из пула (не больше pool_size),
+      их HTTP сессии получают keep-alive адаптер с таймаутами.
+    - Клиенты без requests.Session (ton_fragment вызывает requests.get напрямую)
+      адаптер получить не могут, поэтому каждая попытка вызова ограничена
+      целиком: через call_timeout секунд она завершается DeadlineExceededError.
+      Поток Python прервать нельзя, брошенный вызов доработает в своем потоке,
+      а его клиент вернется в пул только после этого, так что зависших
+      вызовов не больше pool_size.
+    - Ошибки повторяются до retries раз с экспоненциальной задержкой и разбросом.
+    - Пока выключатель разомкнут, вызовы сразу завершаются CircuitOpenError,
+      и обработчики переходят к кэшированным данным.
+    - on_call(name, duration, error) вызывается после каждой попытки вызова API.
+    - Вызов с deadline (time.monotonic()) возвращает управление не позже этого
+      срока: ожидание клиента, ожидание попытки и повторы ограничены им так же,
+      как call_timeout (незавершенная попытка бросается).
+    - Модуль ton_fragment импортируется функцией load_module при первом
+      вызове, а client_factory(module) создает клиентов по мере надобности.
+    """
+
+    def __init__(self, load_module, client_factory, pool_size=8, connect_timeout=5, read_timeout=15,
+                 call_timeout=None, retries=2, backoff_base=0.5, backoff_max=8, breaker=None, on_call=None):
+        self.load_module = load_module
+        self._module = None
+        self.client_factory = client_factory
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.call_timeout = call_timeout or connect_timeout + read_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.on_call = on_call
+
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._pool_lock = threading.Lock()
+
+        # Установлены ли HTTP таймауты в сессии клиентов (None, пока клиентов нет)
+        self.http_timeouts = None
+        # Брошенные по таймауту вызовы, которые еще выполняются
+        self.abandoned = 0
+
+        self._metrics_lock = threading.Lock()
+        self.metrics = {}
+
+    # Модуль ton_fragment (импортируется при первом обращении)
+    @property
+    def module(self):
+        if self._module is None:
+            with self._pool_lock:
+                if self._module is None:
+                    self._module = self.load_module()
+        return self._module
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    # Создание клиента ton_fragment с настроенной HTTP сессией
+    def _create_client(self):
+        client = self.client_factory(self.module)
+        session = getattr(client, 'session', None)
+        if isinstance(session, requests.Session):
+            adapter = TimeoutHTTPAdapter(self.timeout, pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.http_timeouts = True
+        elif self.http_timeouts is None:
+            self.http_timeouts = False
+            logger.warning(
+                "Клиент ton_fragment не использует requests.Session: HTTP таймауты %s не установлены, "
+                "вызовы ограничены только общим таймаутом %s с", self.timeout, self.call_timeout
+            )
+        return client
+
+    # Получение клиента из пула (не дольше timeout секунд)
+    def _acquire(self, timeout=None):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._pool_lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._create_client()
+            except Exception:
+                with self._pool_lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._pool.get(timeout=timeout)
+        except queue.Empty:
+            raise DeadlineExceededError(f"No Fragment API client became available in {timeout:.1f}s")
+
+    def _release(self, client):
+        self._pool.put(client)
+
+    # Запуск попытки вызова в отдельном потоке, клиент возвращается в пул по ее завершении
+    def _start(self, func, client, args, http_timeout):
+        future = Future()
+
+        def run():
+            _request_timeout.value = http_timeout
+            try:
+                future.set_result(func(client, *args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                _request_timeout.value = None
+                self._release(client)
+
+        # Поток-демон не задерживает остановку процесса, если вызов завис
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name="fragment-call", daemon=True).start()
+        return future
+
+    # Учет вызова, результат которого больше не ждут
+    def _abandon(self, name, future, timeout):
+        logger.warning("Вызов %s не завершился за %.1f с, его результат будет отброшен", name, timeout)
+        with self._pool_lock:
+            self.abandoned += 1
+
+        def finished(_):
+            with self._pool_lock:
+                self.abandoned -= 1
+
+        future.add_done_callback(finished)
+
+    # Учет метрик вызова
+    def _record(self, name, duration, error=None, retried=False):
+        with self._metrics_lock:
+            stats = self.metrics.setdefault(name, {
+                "calls": 0, "errors": 0, "retries": 0, "rejected": 0,
+                "totalTime": 0.0, "maxTime": 0.0, "lastError": None
+            })
+            if retried:
+                stats["retries"] += 1
+                return
+            if error is CircuitOpenError:
+                stats["rejected"] += 1
+                return
+            stats["calls"] += 1
+            stats["totalTime"] += duration
+            stats["maxTime"] = max(stats["maxTime"], duration)
+            if error is not None:
+                stats["errors"] += 1
+                stats["lastError"] = str(error)
+
+        if self.on_call is not None:
+            self.on_call(name, duration, error)
+
+    # Задержка перед повтором (full jitter)
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # Вызов функции ton_fragment с повторами и выключателем
+    # (abandon=False: результат ждется без ограничения, попытка не бросается по таймауту)
+    def call(self, name, *args, retry=True, deadline=None, abandon=True):
+        func = getattr(self.module, name)
+        attempts = self.retries + 1 if retry else 1
+
+        for attempt in range(attempts):
+            timeout = self.call_timeout
+            http_timeout = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceededError(f"Deadline exceeded for call {name}")
+                # Попытка и ее HTTP запросы не выходят за срок вызова
+                timeout = min(timeout, remaining)
+                http_timeout = tuple(min(limit, remaining) for limit in self.timeout)
+
+            started = time.perf_counter()
+            client = self._acquire(timeout)
+            # Ожидание клиента входит в время попытки
+            timeout = max(0, timeout - (time.perf_counter() - started))
+
+            if not self.breaker.allow():
+                self._release(client)
+                self._record(name, 0, CircuitOpenError)
+                raise CircuitOpenError(f"Fragment API unavailable, call {name} rejected")
+
+            future = self._start(func, client, args, http_timeout)
+            done, _ = wait((future,), timeout=timeout if abandon else None)
+            if done:
+                try:
+                    result = future.result()
+                    error = None
+                except Exception as e:
+                    error = e
+            else:
+                self._abandon(name, future, timeout)
+                error = DeadlineExceededError(f"Call {name} did not finish in {timeout:.1f}s")
+            duration = time.perf_counter() - started
+
+            if error is None:
+                self._record(name, duration)
+                self.breaker.record_success()
+                return result
+
+            self._record(name, duration, error)
+            self.breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise error
+
+            delay = self._backoff(attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                # Повтор уже не успеет завершиться до срока
+                raise error
+
+            logger.warning("Ошибка вызова %s (попытка %s/%s): %s", name, attempt + 1, attempts, error)
+            self._record(name, 0, retried=True)
+            time.sleep(delay)
+
+    # Снимок метрик вызовов
+    def stats(self):
+        with self._metrics_lock:
+            calls = {name: dict(stats) for name, stats in self.metrics.items()}
+        return {
+            "circuit": self.breaker.state,
+            "httpTimeouts": self.http_timeouts,
+            "abandoned": self.abandoned,
+            "calls": calls
+        }
+
+    def get_all_gifts(self):
+        return self.call('get_all_gifts')
+
+    def get_gifts_by_collection(self, collection):
+        return self.call('get_gifts_by_collection', collection)
+
+    def get_all_collections(self):
+        return self.call('get_all_collections')
+
+    def get_gift_by_id(self, gift_id, deadline=None):
+        return self.call('get_gift_by_id', gift_id, deadline=deadline)
+
+    # Покупка не повторяется автоматически и не бросается по таймауту, чтобы не купить подарок дважды
+    def buy_gift(self, gift_id, recipient):
+        return self.call('buy_gift', gift_id, recipient, retry=False, abandon=False)
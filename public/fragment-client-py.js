@@ -211,28 +211,44 @@ class FragmentClientPy {
         try {
             console.log(`Покупка подарка Fragment с ID ${giftId} для получателя ${recipient}`);
             
-            // Выполняем запрос к бэкенду
-            const response = await fetch(`${this.backendUrl}/api/fragment/buy`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    giftId,
-                    recipient
-                })
-            });
-            
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
+            // Ключ идемпотентности защищает от повторной покупки при повторе запроса
+            const idempotencyKey = `${giftId}:${recipient}:${Date.now()}:${Math.random().toString(36).slice(2)}`;
+            
+            // Ставим покупку в очередь бэкенда (повторяем запрос при сетевой ошибке с тем же ключом)
+            let data = null;
+            for (let attempt = 0; attempt < 3 && !data; attempt++) {
+                try {
+                    const response = await fetch(`${this.backendUrl}/api/fragment/buy`, {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json',
+                            'Idempotency-Key': idempotencyKey
+                        },
+                        body: JSON.stringify({
+                            giftId,
+                            recipient
+                        })
+                    });
+                    
+                    data = await response.json();
+                } catch (networkError) {
+                    if (attempt === 2) {
+                        throw networkError;
+                    }
+                }
             }
             
-            const data = await response.json();
-            
             if (!data.success) {
                 throw new Error(data.error || 'Unknown error');
             }
             
+            // Ожидаем завершения покупки
+            const job = await this.waitForPurchase(data.jobId);
+            
+            if (job.status !== 'succeeded') {
+                throw new Error(job.error || `Purchase ${job.status}`);
+            }
+            
             // Сбрасываем кэш
             this.giftsCache = null;
             this.lastCacheUpdate = null;
@@ -240,9 +256,9 @@ class FragmentClientPy {
             console.log(`Подарок Fragment с ID ${giftId} успешно куплен для получателя ${recipient}`);
             return {
                 success: true,
-                message: data.message,
-                transactionId: data.transactionId,
-                isSimulated: data.isSimulated || false
+                message: `Gift ${giftId} successfully purchased and sent to ${recipient}`,
+                transactionId: job.transactionId,
+                isSimulated: false
             };
         } catch (error) {
             console.error(`Ошибка при покупке подарка Fragment с ID ${giftId}:`, error);
@@ -252,6 +268,36 @@ class FragmentClientPy {
             };
         }
     }
+    
+    /**
+     * Ожидание завершения покупки
+     * @param {string} jobId - ID задачи покупки
+     * @param {number} timeout - Максимальное время ожидания в миллисекундах
+     * @returns {Promise<Object>} Состояние покупки
+     */
+    async waitForPurchase(jobId, timeout = 60 * 1000) {
+        const startedAt = Date.now();
+        let delay = 500;
+        
+        while (Date.now() - startedAt < timeout) {
+            const response = await fetch(`${this.backendUrl}/api/fragment/buy/${jobId}`);
+            
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            
+            const data = await response.json();
+            
+            if (data.job.status !== 'queued' && data.job.status !== 'processing') {
+                return data.job;
+            }
+            
+            await new Promise(resolve => setTimeout(resolve, delay));
+            delay = Math.min(delay * 2, 5000);
+        }
+        
+        throw new Error(`Purchase ${jobId} is still in progress`);
+    }
 }
 
 // Создаем и экспортируем экземпляр клиента
@@ -5,6 +5,7 @@
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
+require('dotenv').config();
 
 // Проверяем наличие Python
 function checkPython() {
@@ -59,42 +60,82 @@ function installDependencies() {
     });
 }
 
+// Адрес проверки готовности бэкенда
+const HEALTH_URL = `http://localhost:${process.env.FRAGMENT_PORT || 5000}/api/fragment/health`;
+const READY_POLL_INTERVAL = 250;
+const READY_TIMEOUT = 60000;
+
 // Запускаем Python-бэкенд
 function startBackend() {
     return new Promise((resolve, reject) => {
-        console.log('Запуск Python-бэкенда...');
+        // Режим asgi запускает production-сервер (uvicorn) вместо отладочного сервера Flask
+        const script = process.env.FRAGMENT_BACKEND_MODE === 'asgi' ? 'fragment_asgi.py' : 'fragment_backend.py';
+        const startedAt = Date.now();
+        let settled = false;
+        let pollTimer = null;
+        
+        console.log(`Запуск Python-бэкенда (${script})...`);
         
-        const pythonProcess = spawn('python', ['fragment_backend.py']);
+        const pythonProcess = spawn('python', [script]);
+        
+        const finish = (callback, value) => {
+            if (settled) {
+                return;
+            }
+            settled = true;
+            clearTimeout(pollTimer);
+            callback(value);
+        };
+        
+        // Опрашиваем /api/fragment/health, пока бэкенд не прогреет каталог
+        const pollHealth = async () => {
+            try {
+                const response = await fetch(HEALTH_URL);
+                if (response.status === 200) {
+                    console.log(`Python-бэкенд готов к работе за ${Date.now() - startedAt} мс.`);
+                    finish(resolve, pythonProcess);
+                    return;
+                }
+            } catch (err) {
+                // Сервер еще не принимает соединения
+            }
+            
+            if (Date.now() - startedAt >= READY_TIMEOUT) {
+                console.warn(`Бэкенд не сообщил о готовности за ${READY_TIMEOUT / 1000} с, продолжаем без ожидания.`);
+                finish(resolve, pythonProcess);
+                return;
+            }
+            
+            if (!settled) {
+                pollTimer = setTimeout(pollHealth, READY_POLL_INTERVAL);
+            }
+        };
         
         pythonProcess.on('error', (err) => {
             console.error('Ошибка при запуске бэкенда:', err);
-            reject(new Error('Не удалось запустить Python-бэкенд.'));
+            finish(reject, new Error('Не удалось запустить Python-бэкенд.'));
         });
         
         pythonProcess.stdout.on('data', (data) => {
             console.log(`Backend: ${data.toString().trim()}`);
-            
-            // Проверяем, запустился ли сервер
-            if (data.toString().includes('Running on')) {
-                console.log('Python-бэкенд успешно запущен.');
-                resolve(pythonProcess);
-            }
         });
         
         pythonProcess.stderr.on('data', (data) => {
             console.error(`Backend error: ${data.toString().trim()}`);
+            
+            // Flask и uvicorn пишут сообщение о запуске в stderr; готовность определяется по /api/fragment/health
+            if (/running on/i.test(data.toString())) {
+                console.log('Python-бэкенд принимает соединения, ожидаем прогрева каталога...');
+            }
         });
         
         pythonProcess.on('close', (code) => {
             if (code !== 0) {
-                reject(new Error(`Python-бэкенд завершил работу с кодом: ${code}`));
+                finish(reject, new Error(`Python-бэкенд завершил работу с кодом: ${code}`));
             }
         });
         
-        // Устанавливаем таймаут на запуск
-        setTimeout(() => {
-            resolve(pythonProcess);
-        }, 5000);
+        pollHealth();
     });
 }
 